@@ -29,7 +29,7 @@ def get_stats():
     )
     if cache_valid:
         return CACHE['data']
-    with db.session_scope() as session:
+    with db.session_scope(read_only=True) as session:
         forts = db.get_forts(session)
     count = {t.value: 0 for t in db.Team}
     strongest = {t.value: None for t in db.Team}
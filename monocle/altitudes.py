@@ -1,7 +1,13 @@
 import sys
 
+from array import array
 from asyncio import gather, CancelledError
-from statistics import mean
+from itertools import islice
+from math import isnan
+from mmap import mmap
+from os import makedirs, replace
+from os.path import join
+from struct import Struct, error as struct_error
 
 from aiohttp import ClientSession
 from polyline import encode as polyencode
@@ -9,27 +15,197 @@ from aiopogo import json_loads
 from cyrandom import uniform
 
 from . import bounds, sanitized as conf
+from .dem import HgtTiles
 from .shared import get_logger, LOOP, run_threaded
-from .utils import dump_pickle, float_range, load_pickle, round_coords
+from .utils import load_pickle, round_coords
+
+# magic, byte order check, precision, south, west, rows, columns
+HEADER = Struct('=4sIIddII4x')
+MAGIC = b'MALT'
+BYTE_ORDER = 0x01020304
+NAN = float('nan')
+
+
+class AltitudeGrid:
+    """Altitudes of every point in a box, in a memory-mapped file
+
+    Points are rounded to precision places and stored row by row from the
+    south-west corner as 32-bit floats, NaN where the altitude is unknown.
+    """
+    def __init__(self, path, south, west, north, east, precision):
+        self.path = path
+        self.precision = precision
+        self.scale = 10 ** precision
+        self.south = round(south, precision)
+        self.west = round(west, precision)
+        self.rows = round((round(north, precision) - self.south) * self.scale) + 1
+        self.columns = round((round(east, precision) - self.west) * self.scale) + 1
+        self.file = self.mapped = self.values = None
+
+    @classmethod
+    def from_file(cls, path):
+        """Map an existing grid, or return None if there's no valid one"""
+        try:
+            with open(path, 'rb') as f:
+                magic, byte_order, precision, south, west, rows, columns = HEADER.unpack(
+                    f.read(HEADER.size))
+        except (OSError, ValueError, struct_error):
+            return None
+        if magic != MAGIC or byte_order != BYTE_ORDER:
+            return None
+        step = 1 / 10 ** precision
+        grid = cls(path, south, west, south + (rows - 1) * step,
+                   west + (columns - 1) * step, precision)
+        return grid if grid.open() else None
+
+    @property
+    def header(self):
+        return HEADER.pack(MAGIC, BYTE_ORDER, self.precision, self.south,
+                           self.west, self.rows, self.columns)
+
+    def open(self):
+        """Map the file, returning False if it doesn't hold this grid"""
+        try:
+            self.file = open(self.path, 'r+b')
+        except FileNotFoundError:
+            return False
+        size = HEADER.size + self.rows * self.columns * 4
+        self.file.seek(0, 2)
+        if self.file.tell() != size or not self.read_header():
+            self.file.close()
+            self.file = None
+            return False
+        self.mapped = mmap(self.file.fileno(), size)
+        self.values = memoryview(self.mapped)[HEADER.size:].cast('f')
+        return True
+
+    def read_header(self):
+        self.file.seek(0)
+        return self.file.read(HEADER.size) == self.header
+
+    def create(self):
+        """Write a file of unknown altitudes and map it"""
+        makedirs(join(conf.DIRECTORY, 'pickles'), exist_ok=True)
+        row = array('f', [NAN]) * self.columns
+        with open(self.path, 'wb') as f:
+            f.write(self.header)
+            for _ in range(self.rows):
+                row.tofile(f)
+        self.open()
+
+    def close(self):
+        if self.values is not None:
+            self.values.release()
+            self.mapped.close()
+            self.file.close()
+        self.file = self.mapped = self.values = None
+
+    def flush(self):
+        if self.mapped is not None:
+            self.mapped.flush()
+
+    def index(self, point):
+        row = round((point[0] - self.south) * self.scale)
+        column = round((point[1] - self.west) * self.scale)
+        if 0 <= row < self.rows and 0 <= column < self.columns:
+            return row * self.columns + column
+        raise KeyError(point)
+
+    def __getitem__(self, point):
+        altitude = self.values[self.index(point)]
+        if isnan(altitude):
+            raise KeyError(point)
+        return altitude
+
+    def __setitem__(self, point, altitude):
+        self.values[self.index(point)] = altitude
+
+    def update(self, altitudes):
+        """Set many altitudes, each run of adjacent points with one slice
+
+        Returns {point: altitude} of the points outside the grid.
+        """
+        outside = {}
+        cells = []
+        for point, altitude in altitudes.items():
+            try:
+                cells.append((self.index(point), altitude))
+            except KeyError:
+                outside[point] = altitude
+        cells.sort()
+        start = 0
+        for i in range(1, len(cells) + 1):
+            if i == len(cells) or cells[i][0] != cells[i - 1][0] + 1:
+                first = cells[start][0]
+                self.values[first:first + i - start] = array(
+                    'f', [altitude for _, altitude in cells[start:i]])
+                start = i
+        return outside
+
+    def point(self, row, column):
+        return (round(self.south + row / self.scale, self.precision),
+                round(self.west + column / self.scale, self.precision))
+
+    def interpolate(self, point):
+        """Bilinear interpolation between the four surrounding points
+
+        The nearest point is used if any of them is unknown.
+        """
+        y = (point[0] - self.south) * self.scale
+        x = (point[1] - self.west) * self.scale
+        row, column = int(y), int(x)
+        if not (0 <= y and 0 <= x and row < self.rows - 1 and column < self.columns - 1):
+            return self[point]
+        south = row * self.columns + column
+        north = south + self.columns
+        dy, dx = y - row, x - column
+        altitude = ((self.values[south] * (1 - dx) + self.values[south + 1] * dx) * (1 - dy) +
+                    (self.values[north] * (1 - dx) + self.values[north + 1] * dx) * dy)
+        if isnan(altitude):
+            return self[point]
+        return altitude
+
+    def known(self):
+        """Yield (row, column, altitude) of every known point"""
+        columns = self.columns
+        for row in range(self.rows):
+            start = row * columns
+            for column, altitude in enumerate(self.values[start:start + columns].tolist()):
+                if not isnan(altitude):
+                    yield row, column, altitude
+
+    def missing(self, south, west, north, east):
+        """Points in the given box whose altitude is unknown"""
+        first_row = max(round((south - self.south) * self.scale), 0)
+        last_row = min(round((north - self.south) * self.scale), self.rows - 1)
+        first_column = max(round((west - self.west) * self.scale), 0)
+        last_column = min(round((east - self.west) * self.scale), self.columns - 1)
+        points = []
+        for row in range(first_row, last_row + 1):
+            start = row * self.columns
+            values = self.values[start + first_column:start + last_column + 1].tolist()
+            points.extend(self.point(row, first_column + i)
+                          for i, altitude in enumerate(values) if isnan(altitude))
+        return points
 
 
 class Altitudes:
     """Manage altitudes"""
-    __slots__ = ('altitudes', 'changed', 'fallback', 'log', 'mean')
+    __slots__ = ('dem', 'fallback', 'grid', 'log', 'mean', 'outside')
 
     def __init__(self):
         self.log = get_logger('altitudes')
-        self.changed = False
+        self.dem = HgtTiles(conf.ALT_DEM_DIRECTORY) if conf.ALT_DEM_DIRECTORY else None
+        # {rounded point: altitude} of fetched points outside the grid
+        self.outside = {}
         self.load()
-        if len(self.altitudes) > 5:
+        if self.count() > 5:
             self.fallback = self.average
         else:
             self.fallback = self.random
 
-    async def get_all(self):
-        self.log.info('Fetching all altitudes')
-
-        coords = self.get_coords()
+    async def get_all(self, coords):
+        self.log.info('Fetching {} altitudes', len(coords))
 
         async with ClientSession(loop=LOOP) as session:
             if len(coords) < 300:
@@ -38,10 +214,9 @@ class Altitudes:
                 tasks = [self.fetch_alts(chunk, session)
                          for chunk in self.chunks(coords)]
                 await gather(*tasks, loop=LOOP)
-        self.changed = True
-        LOOP.create_task(run_threaded(self.pickle))
+        LOOP.create_task(run_threaded(self.save))
 
-    async def fetch_alts(self, coords, session, precision=conf.ALT_PRECISION):
+    async def fetch_alts(self, coords, session):
         try:
             async with session.get(
                     'https://maps.googleapis.com/maps/api/elevation/json',
@@ -49,20 +224,34 @@ class Altitudes:
                             'key': conf.GOOGLE_MAPS_KEY},
                     timeout=10) as resp:
                 response = await resp.json(loads=json_loads)
-            for r in response['results']:
-                coords = round_coords((r['location']['lat'], r['location']['lng']), precision)
-                self.altitudes[coords] = r['elevation']
-            if not self.altitudes:
+            self.store({(r['location']['lat'], r['location']['lng']): r['elevation']
+                        for r in response['results']})
+            if not response['results']:
                 self.log.error(response['error_message'])
         except Exception:
             self.log.exception('Error fetching altitudes.')
 
     def get(self, point, randomize=uniform):
-        point = round_coords(point, conf.ALT_PRECISION)
-        alt = self.altitudes[point]
+        try:
+            if conf.ALT_INTERPOLATE:
+                alt = self.grid.interpolate(point)
+            else:
+                alt = self.grid[point]
+        except KeyError:
+            alt = self.outside[round_coords(point, self.grid.precision)]
         return randomize(alt - 2.5, alt + 2.5)
 
+    def store(self, altitudes):
+        """Write {point: altitude} into the grid, keeping those outside it"""
+        precision = self.grid.precision
+        for point, altitude in self.grid.update(altitudes).items():
+            self.outside[round_coords(point, precision)] = altitude
+
     async def fetch(self, point, key=conf.GOOGLE_MAPS_KEY):
+        if self.dem:
+            altitude = self.dem.elevation(point)
+            if altitude is not None:
+                return altitude
         if not key:
             return self.fallback()
         try:
@@ -74,8 +263,7 @@ class Altitudes:
                         timeout=10) as resp:
                     response = await resp.json(loads=json_loads)
                     altitude = response['results'][0]['elevation']
-                    self.altitudes[point] = altitude
-                    self.changed = True
+                    self.store({point: altitude})
                     return altitude
         except CancelledError:
             raise
@@ -91,71 +279,81 @@ class Altitudes:
         try:
             return randomize(self.mean - 15.0, self.mean + 15.0)
         except AttributeError:
-            self.mean = mean(self.altitudes.values())
+            total = count = 0
+            for _, _, altitude in self.grid.known():
+                total += altitude
+                count += 1
+            self.mean = total / count
             return self.average()
 
     def random(self, alt_range=conf.ALT_RANGE, randomize=uniform):
         self.log.info('Fell back to random altitude.')
         return randomize(*conf.ALT_RANGE)
 
+    def count(self, limit=6):
+        return sum(1 for _ in islice(self.grid.known(), limit))
+
     def load(self):
+        # shards share the grid of the whole area
+        area = getattr(bounds, 'parent', bounds)
+        path = join(conf.DIRECTORY, 'pickles', 'altitudes.grid')
+        self.grid = AltitudeGrid(path, area.south, area.west, area.north,
+                                 area.east, conf.ALT_PRECISION)
+        if not self.grid.open():
+            self.log.info('Creating a new altitude grid.')
+            self.rebuild()
+
+        coords = self.get_coords()
+        if self.dem and coords:
+            missing = self.dem.fill(self.grid, coords)
+            self.log.info('Read {} altitudes from {}.', len(coords) - len(missing),
+                          conf.ALT_DEM_DIRECTORY)
+            self.save()
+            coords = missing
+
+        if coords and conf.GOOGLE_MAPS_KEY:
+            LOOP.run_until_complete(self.get_all(coords))
+
+    def rebuild(self):
+        """Create the grid, with whatever altitudes are already known"""
+        previous = AltitudeGrid.from_file(self.grid.path)
+        final = self.grid.path
+        self.grid.path += '.tmp'
+        self.grid.create()
+        if previous:
+            if previous.precision <= self.grid.precision:
+                for row, column, altitude in previous.known():
+                    self.copy(previous.point(row, column), altitude)
+            previous.close()
+        else:
+            try:
+                state = load_pickle('altitudes', raise_exception=True)
+                if state['precision'] <= self.grid.precision:
+                    for point, altitude in state['altitudes'].items():
+                        self.copy(point, altitude)
+            except FileNotFoundError:
+                pass
+        self.grid.close()
+        replace(self.grid.path, final)
+        self.grid.path = final
+        self.grid.open()
+
+    def copy(self, point, altitude):
         try:
-            state = load_pickle('altitudes', raise_exception=True)
-        except FileNotFoundError:
-            self.log.info('No altitudes pickle found.')
-            self.altitudes = {}
-            LOOP.run_until_complete(self.get_all())
-            return
-
-        if state['bounds_hash'] == hash(bounds):
-            if state['precision'] == conf.ALT_PRECISION and state['altitudes']:
-                self.altitudes = state['altitudes']
-                return
-            elif state['precision'] < conf.ALT_PRECISION:
-                self.altitudes = state['altitudes']
-                LOOP.run_until_complete(self.get_all())
-                return
-        elif state['precision'] <= conf.ALT_PRECISION:
-            pickled_alts = state['altitudes']
-
-            to_remove = []
-            for coords in pickled_alts.keys():
-                if coords not in bounds:
-                    to_remove.append(coords)
-            for key in to_remove:
-                del pickled_alts[key]
-
-            self.altitudes = pickled_alts
-            LOOP.run_until_complete(self.get_all())
-            return
-        self.altitudes = {}
-        LOOP.run_until_complete(self.get_all())
-
-    def pickle(self):
-        if self.changed:
-            state = {
-                'altitudes': self.altitudes,
-                'precision': conf.ALT_PRECISION,
-                'bounds_hash': hash(bounds)
-            }
-            dump_pickle('altitudes', state)
-            self.changed = False
-
-    def get_coords(self, bounds=bounds, precision=conf.ALT_PRECISION):
-        coords = []
+            self.grid[point] = altitude
+        except KeyError:
+            pass
+
+    def save(self):
+        self.grid.flush()
+
+    def get_coords(self, bounds=bounds):
         if bounds.multi:
+            coords = []
             for b in bounds.polygons:
                 coords.extend(self.get_coords(b))
             return coords
-        step = 1 / (10 ** precision)
-        west, east = bounds.west, bounds.east
-        existing = self.altitudes.keys() if self.altitudes else False
-        for lat in float_range(bounds.south, bounds.north, step):
-            for lon in float_range(west, east, step):
-                point = lat, lon
-                if not existing or point not in existing:
-                    coords.append(round_coords(point, precision))
-        return coords
+        return self.grid.missing(bounds.south, bounds.west, bounds.north, bounds.east)
 
     @staticmethod
     def chunks(l, n=300):
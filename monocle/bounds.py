@@ -1,5 +1,7 @@
 import sys
 
+from os import environ
+
 from . import sanitized as conf
 from .utils import get_distance
 
@@ -75,6 +77,27 @@ class RectBounds(Bounds):
         return hash((self.north, self.east, self.south, self.west))
 
 
+class ShardBounds(RectBounds):
+    """Rectangular region of the boundaries scanned by one shard process"""
+    def __init__(self, parent, north, east, south, west):
+        self.parent = parent
+        self.north = north
+        self.east = east
+        self.south = south
+        self.west = west
+        self.center = ((north + south) / 2, (west + east) / 2)
+        self.multi = False
+
+    def __bool__(self):
+        return True
+
+    def __contains__(self, p):
+        return super().__contains__(p) and p in self.parent
+
+    def __hash__(self):
+        return hash((hash(self.parent), self.north, self.east, self.south, self.west))
+
+
 if conf.BOUNDARIES:
     try:
         from shapely.geometry import MultiPolygon, Point, Polygon
@@ -92,3 +115,8 @@ elif conf.STAY_WITHIN_MAP:
     sys.modules[__name__] = RectBounds()
 else:
     sys.modules[__name__] = Bounds()
+
+# set by the supervisor for each shard process, as north,east,south,west
+if environ.get('MONOCLE_SHARD'):
+    region = (float(x) for x in environ['MONOCLE_SHARD'].split(','))
+    sys.modules[__name__] = ShardBounds(sys.modules[__name__], *region)
@@ -0,0 +1,138 @@
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from mmap import mmap, ACCESS_READ
+from os import makedirs, replace
+from os.path import join
+from struct import Struct, error as struct_error
+
+from . import sanitized as conf
+from .shared import get_logger
+from .utils import round_coords
+
+# magic, byte order check, number of points
+HEADER = Struct('=4sIQ')
+MAGIC = b'MCEL'
+BYTE_ORDER = 0x01020304
+
+
+def pack_point(point):
+    """Combine coordinates rounded to 4 places into one unsigned integer"""
+    return (round(point[0] * 10000) + 900000) * 4000000 + round(point[1] * 10000) + 1800000
+
+
+class CellCache:
+    """Cell IDs of rounded points, the most recently used kept in memory
+
+    Up to size points are kept in memory, others are looked up in a file
+    that is memory-mapped the first time it's needed. The file has the
+    sorted packed points, the offset of each point's cell IDs, and the cell
+    IDs themselves, all as 64-bit integers. Points added since the file was
+    written are merged into it by save(), unless they were evicted first.
+    """
+    def __init__(self, get_cell_ids, size=conf.CACHE_CELLS_SIZE):
+        self.get_cell_ids = get_cell_ids
+        self.size = size
+        self.path = join(conf.DIRECTORY, 'pickles', 'cells.bin')
+        self.log = get_logger('cells')
+        # {packed point: cell IDs}
+        self.recent = OrderedDict()
+        # packed points that aren't in the file
+        self.new = set()
+        self.file = None
+        self.mapped = self.view = None
+        self.keys = self.offsets = self.ids = ()
+
+    def __len__(self):
+        return len(self.recent)
+
+    def get(self, point):
+        rounded = round_coords(point, 4)
+        key = pack_point(rounded)
+        try:
+            self.recent.move_to_end(key)
+            return self.recent[key]
+        except KeyError:
+            pass
+        if self.file is None:
+            self.open()
+        cells = self.lookup(key)
+        if cells is None:
+            cells = self.get_cell_ids(rounded)
+            self.new.add(key)
+        self.recent[key] = cells
+        if len(self.recent) > self.size:
+            evicted, _ = self.recent.popitem(last=False)
+            self.new.discard(evicted)
+        return cells
+
+    def open(self):
+        try:
+            self.file = open(self.path, 'rb')
+        except FileNotFoundError:
+            # don't look for it again until it's saved
+            self.file = False
+            return
+        try:
+            self.mapped = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+            magic, byte_order, count = HEADER.unpack_from(self.mapped)
+            if magic != MAGIC or byte_order != BYTE_ORDER:
+                raise ValueError('not a cell cache from this system')
+        except (OSError, ValueError, struct_error) as e:
+            self.log.warning('Ignoring {}: {}', self.path, e)
+            self.close()
+            self.file = False
+            return
+        self.view = memoryview(self.mapped)
+        start = HEADER.size
+        self.keys = self.view[start:start + count * 8].cast('Q')
+        start += count * 8
+        self.offsets = self.view[start:start + (count + 1) * 8].cast('Q')
+        start += (count + 1) * 8
+        self.ids = self.view[start:].cast('Q')
+
+    def close(self):
+        # the mapping can't be closed while views of it exist
+        for view in (self.keys, self.offsets, self.ids, self.view):
+            if isinstance(view, memoryview):
+                view.release()
+        self.keys = self.offsets = self.ids = ()
+        self.view = None
+        if self.mapped:
+            self.mapped.close()
+        if self.file:
+            self.file.close()
+        self.mapped = self.file = None
+
+    def lookup(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return array('Q', self.ids[self.offsets[i]:self.offsets[i + 1]].tobytes())
+
+    def save(self):
+        """Merge the points added since the last save into the file"""
+        if not self.new:
+            return
+        if self.file is None:
+            self.open()
+        keys = sorted(set(self.keys).union(self.new))
+        makedirs(join(conf.DIRECTORY, 'pickles'), exist_ok=True)
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(HEADER.pack(MAGIC, BYTE_ORDER, len(keys)))
+            array('Q', keys).tofile(f)
+            offsets = array('Q', [0])
+            for key in keys:
+                offsets.append(offsets[-1] + len(self.cells_of(key)))
+            offsets.tofile(f)
+            for key in keys:
+                array('Q', self.cells_of(key)).tofile(f)
+        self.close()
+        replace(self.path + '.tmp', self.path)
+        self.new.clear()
+        self.log.info('Saved the cell IDs of {} points.', len(keys))
+
+    def cells_of(self, key):
+        try:
+            return self.recent[key]
+        except KeyError:
+            return self.lookup(key)
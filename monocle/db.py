@@ -1,17 +1,19 @@
 from datetime import datetime
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from contextlib import contextmanager
 from enum import Enum
+from threading import Lock
 from time import time, mktime
 
-from sqlalchemy import Column, Integer, String, Float, SmallInteger, BigInteger, ForeignKey, UniqueConstraint, create_engine, cast, func, desc, asc, and_, exists
+from sqlalchemy import Column, Integer, String, Float, SmallInteger, BigInteger, ForeignKey, UniqueConstraint, create_engine, cast, func, desc, asc, and_, exists, bindparam, event
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.types import TypeDecorator, Numeric, Text
 from sqlalchemy.ext.declarative import declarative_base
 
 from . import bounds, spawns, db_proc, sanitized as conf
 from .utils import time_until_time, dump_pickle, load_pickle
-from .shared import call_at, get_logger
+from .shared import get_logger
 
 try:
     assert conf.LAST_MIGRATION < time()
@@ -78,21 +80,65 @@ def combine_key(sighting):
     return sighting['encounter_id'], sighting['spawn_id']
 
 
+class ExpiryWheel:
+    """Keys in buckets of resolution seconds by the time they expire
+
+    expired() returns the keys from buckets that have passed since it was
+    last called, so keys come out up to resolution seconds late.
+    """
+    def __init__(self, resolution=10):
+        self.resolution = resolution
+        # {bucket: [key, ...]}
+        self.buckets = defaultdict(list)
+        # first bucket that hasn't passed yet
+        self.current = int(time() // resolution)
+        self.lock = Lock()
+
+    def add(self, key, when):
+        # without the lock a key could land in a bucket that expired() has
+        # already passed, and it would never come out
+        with self.lock:
+            self.buckets[max(int(when // self.resolution), self.current)].append(key)
+
+    def expired(self, now):
+        bucket = int(now // self.resolution)
+        # the caches are used from the event loop and the DB processor
+        if bucket <= self.current or not self.lock.acquire(False):
+            return ()
+        try:
+            keys = []
+            for number in range(self.current, bucket):
+                keys.extend(self.buckets.pop(number, ()))
+            self.current = bucket
+            return keys
+        finally:
+            self.lock.release()
+
+
 class SightingCache:
     """Simple cache for storing actual sightings
 
     It's used in order not to make as many queries to the database.
-    It schedules sightings to be removed as soon as they expire.
+    Sightings are removed once they expire, whenever the cache is used.
     """
     def __init__(self):
         self.store = {}
+        self.wheel = ExpiryWheel()
 
     def __len__(self):
         return len(self.store)
 
     def add(self, sighting):
         self.store[sighting['spawn_id']] = sighting['expire_timestamp']
-        call_at(sighting['expire_timestamp'], self.remove, sighting['spawn_id'])
+        self.wheel.add(sighting['spawn_id'], sighting['expire_timestamp'])
+        self.sweep()
+
+    def sweep(self):
+        now = time()
+        for spawn_id in self.wheel.expired(now):
+            # it may have been seen again since
+            if self.store.get(spawn_id, now) <= now:
+                self.remove(spawn_id)
 
     def remove(self, spawn_id):
         try:
@@ -101,6 +147,7 @@ class SightingCache:
             pass
 
     def __contains__(self, raw_sighting):
+        self.sweep()
         try:
             expire_timestamp = self.store[raw_sighting['spawn_id']]
             return (
@@ -114,20 +161,36 @@ class MysteryCache:
     """Simple cache for storing Pokemon with unknown expiration times
 
     It's used in order not to make as many queries to the database.
-    It schedules sightings to be removed an hour after being seen.
+    Sightings are removed an hour after first being seen, whenever the cache
+    is used.
     """
     def __init__(self):
         self.store = {}
+        self.wheel = ExpiryWheel()
 
     def __len__(self):
         return len(self.store)
 
-    def add(self, sighting):
+    def add(self, sighting, first_seen=None):
         key = combine_key(sighting)
-        self.store[combine_key(sighting)] = [sighting['seen']] * 2
-        call_at(sighting['seen'] + 3510, self.remove, key)
+        if first_seen is None:
+            first_seen = sighting['seen']
+        self.store[key] = [first_seen, sighting['seen']]
+        self.wheel.add(key, first_seen + 3510)
+        self.sweep()
+
+    def sweep(self):
+        now = time()
+        for key in self.wheel.expired(now):
+            try:
+                # it may have been removed and added again since
+                if self.store[key][0] + 3510 <= now:
+                    self.remove(key)
+            except KeyError:
+                pass
 
     def __contains__(self, raw_sighting):
+        self.sweep()
         key = combine_key(raw_sighting)
         try:
             first, last = self.store[key]
@@ -139,8 +202,10 @@ class MysteryCache:
         return True
 
     def remove(self, key):
-        first, last = self.store[key]
-        del self.store[key]
+        try:
+            first, last = self.store.pop(key)
+        except KeyError:
+            return
         if last != first:
             encounter_id, spawn_id = key
             db_proc.add({
@@ -152,7 +217,7 @@ class MysteryCache:
             })
 
     def items(self):
-        return self.store.items()
+        return tuple(self.store.items())
 
 
 class FortCache:
@@ -160,6 +225,9 @@ class FortCache:
     def __init__(self):
         self.gyms = {}
         self.pokestops = set()
+        # {external_id: fort.id}, loaded by the DB processor before its
+        # first fort or pokestop
+        self.ids = None
         self.class_version = 2
         self.unpickle()
 
@@ -175,8 +243,16 @@ class FortCache:
         except KeyError:
             return False
 
+    def load_ids(self, session):
+        """Load every fort's id and every pokestop with one query each"""
+        self.ids = dict(session.query(Fort.external_id, Fort.id))
+        self.pokestops.update(external_id for external_id, in
+                              session.query(Pokestop.external_id))
+
     def pickle(self):
         state = self.__dict__.copy()
+        # ids are only valid for the database they were loaded from
+        del state['ids']
         state['db_hash'] = spawns.db_hash
         state['bounds_hash'] = hash(bounds)
         dump_pickle('forts', state)
@@ -192,15 +268,173 @@ class FortCache:
             pass
 
 
+class SpawnpointCache:
+    """Spawnpoint rows kept in memory so that updating them needs no query
+
+    Rows are loaded along with the spawns, or from the database the first
+    time any other spawnpoint is needed. Changed rows are written together
+    by flush() before each commit, and put back as they were at the last
+    commit if the transaction is rolled back.
+    """
+    def __init__(self):
+        # {spawn_id: {column: value}}
+        self.rows = {}
+        # spawn_ids of rows changed since the last flush
+        self.dirty = set()
+        # {spawn_id: copy of the row} as of the last commit, for changed rows
+        self.originals = {}
+        # spawn_ids of rows written by the last flush but not yet committed
+        self.flushed = set()
+        # spawn_ids of rows inserted since the last commit
+        self.inserted = set()
+        # spawns are loaded in another thread than the DB processor's
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def load(self, spawnpoint):
+        """Keep a row read from the database
+
+        A kept row is only replaced if it has no changes that are yet to be
+        committed, so that spawn updates pick up rows written by another
+        process without losing this one's changes. It's updated in place
+        since the DB processor may be holding it.
+        """
+        spawn_id = spawnpoint.spawn_id
+        with self.lock:
+            if (spawn_id in self.dirty or spawn_id in self.flushed
+                    or spawn_id in self.inserted):
+                return
+            self.rows.setdefault(spawn_id, {}).update(
+                spawn_id=spawn_id,
+                despawn_time=spawnpoint.despawn_time,
+                lat=spawnpoint.lat,
+                lon=spawnpoint.lon,
+                updated=spawnpoint.updated,
+                duration=spawnpoint.duration,
+                failures=spawnpoint.failures)
+
+    def get(self, session, spawn_id):
+        try:
+            return self.rows[spawn_id]
+        except KeyError:
+            spawnpoint = session.query(Spawnpoint) \
+                .filter(Spawnpoint.spawn_id == spawn_id) \
+                .first()
+            if spawnpoint:
+                self.load(spawnpoint)
+                return self.rows[spawn_id]
+
+    def add(self, session, row):
+        insert_rows(session, Spawnpoint.__table__, [row])
+        self.added(row)
+
+    def added(self, row):
+        """Keep a row that was inserted in the current transaction"""
+        with self.lock:
+            self.rows[row['spawn_id']] = row
+            self.inserted.add(row['spawn_id'])
+
+    def change(self, spawn_id):
+        """Call before changing a kept row, so a rollback can undo it"""
+        if spawn_id not in self.originals:
+            self.originals[spawn_id] = self.rows[spawn_id].copy()
+        self.dirty.add(spawn_id)
+
+    def flush(self, session):
+        if not self.dirty:
+            return
+        table = Spawnpoint.__table__
+        session.execute(
+            table.update().where(table.c.spawn_id == bindparam('b_spawn_id')),
+            [{'b_spawn_id': spawn_id,
+              'despawn_time': row['despawn_time'],
+              'updated': row['updated'],
+              'duration': row['duration'],
+              'failures': row['failures']}
+             for spawn_id, row in ((x, self.rows[x]) for x in self.dirty)])
+        self.flushed.update(self.dirty)
+        self.dirty.clear()
+
+    def committed(self):
+        self.flushed.clear()
+        self.inserted.clear()
+        self.originals.clear()
+
+    def rolled_back(self):
+        # items are written again after a rollback, so their changes must
+        # not be applied twice
+        self.dirty.clear()
+        self.flushed.clear()
+        with self.lock:
+            for spawn_id, original in self.originals.items():
+                row = self.rows[spawn_id]
+                row.clear()
+                row.update(original)
+            self.originals.clear()
+            # the rows were never written, they'll be inserted again if needed
+            for spawn_id in self.inserted:
+                self.rows.pop(spawn_id, None)
+            self.inserted.clear()
+
+
 SIGHTING_CACHE = SightingCache()
 MYSTERY_CACHE = MysteryCache()
 FORT_CACHE = FortCache()
+SPAWNPOINT_CACHE = SpawnpointCache()
 
 Base = declarative_base()
 
 _engine = create_engine(conf.DB_ENGINE)
 Session = sessionmaker(bind=_engine)
 DB_TYPE = _engine.name
+SQLITE_WAL = DB_TYPE == 'sqlite' and conf.SQLITE_WAL
+
+
+def tune_sqlite(connection, record=None):
+    # readers don't block the writer in WAL mode, and with WAL a NORMAL sync
+    # can only lose the last commits on power loss, never corrupt the file
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('PRAGMA mmap_size=268435456')  # 256MB
+    connection.execute('PRAGMA cache_size=-65536')  # 64MB
+
+
+def forbid_writes(connection, record=None):
+    connection.execute('PRAGMA query_only=ON')
+
+
+if SQLITE_WAL:
+    event.listen(_engine, 'connect', tune_sqlite)
+    # the DB processor keeps one connection open for all of its writes
+    _writer_engine = create_engine(conf.DB_ENGINE, poolclass=StaticPool)
+    event.listen(_writer_engine, 'connect', tune_sqlite)
+    WriterSession = sessionmaker(bind=_writer_engine)
+    # the web frontends only read, so their connections refuse writes
+    _reader_engine = create_engine(conf.DB_ENGINE)
+    event.listen(_reader_engine, 'connect', tune_sqlite)
+    event.listen(_reader_engine, 'connect', forbid_writes)
+    ReaderSession = sessionmaker(bind=_reader_engine)
+else:
+    WriterSession = ReaderSession = Session
+
+
+# INSERT statements that skip rows violating a unique constraint, so that
+# the database checks for duplicates instead of a query before each insert
+if DB_TYPE == 'postgresql':
+    from sqlalchemy.dialects.postgresql import insert as _pg_insert
+
+    def insert_ignore(table):
+        return _pg_insert(table).on_conflict_do_nothing()
+elif DB_TYPE == 'mysql':
+    def insert_ignore(table):
+        return table.insert().prefix_with('IGNORE')
+elif DB_TYPE == 'sqlite':
+    def insert_ignore(table):
+        return table.insert().prefix_with('OR IGNORE')
+else:
+    insert_ignore = None
 
 
 if conf.REPORT_SINCE:
@@ -319,10 +553,28 @@ class Pokestop(Base):
     lon = Column(FLOAT_TYPE, index=True)
 
 
+# INSERT statements built once so that their compiled form can be reused,
+# and which skip duplicate rows where the database supports it
+INSERTS = {table: insert_ignore(table) if insert_ignore else table.insert()
+           for table in Base.metadata.sorted_tables}
+COMPILED_CACHE = {}
+
+
+def execute_cached(session, statement, params):
+    """Execute a statement, caching its compiled form
+
+    Only use this with statements that are kept, such as INSERTS, since the
+    cache grows with each new statement. Executes many with a list of rows.
+    """
+    return session.connection() \
+        .execution_options(compiled_cache=COMPILED_CACHE) \
+        .execute(statement, params)
+
+
 @contextmanager
-def session_scope(autoflush=False):
+def session_scope(autoflush=False, read_only=False):
     """Provide a transactional scope around a series of operations."""
-    session = Session(autoflush=autoflush)
+    session = (ReaderSession if read_only else Session)(autoflush=autoflush)
     try:
         yield session
         session.commit()
@@ -337,29 +589,64 @@ def add_sighting(session, pokemon):
     # Check if there isn't the same entry already
     if pokemon in SIGHTING_CACHE:
         return
-    if session.query(exists().where(and_(
+    if insert_ignore or not session.query(exists().where(and_(
                 Sighting.expire_timestamp == pokemon['expire_timestamp'],
                 Sighting.encounter_id == pokemon['encounter_id']))
             ).scalar():
-        SIGHTING_CACHE.add(pokemon)
-        return
-    obj = Sighting(
-        pokemon_id=pokemon['pokemon_id'],
-        spawn_id=pokemon['spawn_id'],
-        encounter_id=pokemon['encounter_id'],
-        expire_timestamp=pokemon['expire_timestamp'],
-        lat=pokemon['lat'],
-        lon=pokemon['lon'],
-        atk_iv=pokemon.get('individual_attack'),
-        def_iv=pokemon.get('individual_defense'),
-        sta_iv=pokemon.get('individual_stamina'),
-        move_1=pokemon.get('move_1'),
-        move_2=pokemon.get('move_2')
-    )
-    session.add(obj)
+        execute_cached(session, INSERTS[Sighting.__table__], sighting_row(pokemon))
     SIGHTING_CACHE.add(pokemon)
 
 
+def sighting_row(pokemon):
+    return {
+        'pokemon_id': pokemon['pokemon_id'],
+        'spawn_id': pokemon['spawn_id'],
+        'encounter_id': pokemon['encounter_id'],
+        'expire_timestamp': pokemon['expire_timestamp'],
+        'lat': pokemon['lat'],
+        'lon': pokemon['lon'],
+        'atk_iv': pokemon.get('individual_attack'),
+        'def_iv': pokemon.get('individual_defense'),
+        'sta_iv': pokemon.get('individual_stamina'),
+        'move_1': pokemon.get('move_1'),
+        'move_2': pokemon.get('move_2')
+    }
+
+
+def insert_rows(session, table, rows):
+    """Insert rows with as few round trips as possible"""
+    if DB_TYPE != 'postgresql':
+        # sqlite3 runs executemany in-process and MySQLdb rewrites it into
+        # multi-row INSERTs
+        execute_cached(session, INSERTS[table], rows)
+        return
+    # psycopg2 executes many one at a time, so use multi-row INSERTs
+    per_statement = 30000 // len(table.columns)
+    for i in range(0, len(rows), per_statement):
+        session.execute(INSERTS[table].values(rows[i:i + per_statement]))
+
+
+def add_sightings(session, sightings):
+    """Add a batch of sightings with one query for duplicates"""
+    new = [pokemon for pokemon in sightings if pokemon not in SIGHTING_CACHE]
+    if not new:
+        return
+    if insert_ignore:
+        existing = set()
+    else:
+        existing = set(session.query(Sighting.encounter_id, Sighting.expire_timestamp)
+            .filter(Sighting.encounter_id.in_({p['encounter_id'] for p in new})))
+    rows = []
+    for pokemon in new:
+        key = pokemon['encounter_id'], pokemon['expire_timestamp']
+        if key not in existing:
+            existing.add(key)
+            rows.append(sighting_row(pokemon))
+        SIGHTING_CACHE.add(pokemon)
+    if rows:
+        insert_rows(session, Sighting.__table__, rows)
+
+
 def add_spawnpoint(session, pokemon):
     # Check if the same entry already exists
     spawn_id = pokemon['spawn_id']
@@ -369,58 +656,65 @@ def add_spawnpoint(session, pokemon):
             return
     except KeyError:
         pass
-    existing = session.query(Spawnpoint) \
-        .filter(Spawnpoint.spawn_id == spawn_id) \
-        .first()
+    existing = SPAWNPOINT_CACHE.get(session, spawn_id)
     now = round(time())
     point = pokemon['lat'], pokemon['lon']
-    spawns.add_known(spawn_id, new_time, point)
     if existing:
-        existing.updated = now
-        existing.failures = 0
+        SPAWNPOINT_CACHE.change(spawn_id)
+        existing['updated'] = now
+        existing['failures'] = 0
 
-        if (existing.despawn_time is None or
-                existing.updated < conf.LAST_MIGRATION):
+        if (existing['despawn_time'] is None or
+                existing['updated'] < conf.LAST_MIGRATION):
             widest = get_widest_range(session, spawn_id)
             if widest and widest > 1800:
-                existing.duration = 60
-        elif new_time == existing.despawn_time:
-            return
+                existing['duration'] = 60
 
-        existing.despawn_time = new_time
+        existing['despawn_time'] = new_time
+        spawns.add_known(spawn_id, new_time, point, existing['duration'])
     else:
         widest = get_widest_range(session, spawn_id)
 
         duration = 60 if widest and widest > 1800 else None
 
-        session.add(Spawnpoint(
-            spawn_id=spawn_id,
-            despawn_time=new_time,
-            lat=pokemon['lat'],
-            lon=pokemon['lon'],
-            updated=now,
-            duration=duration,
-            failures=0
-        ))
+        SPAWNPOINT_CACHE.add(session, {
+            'spawn_id': spawn_id,
+            'despawn_time': new_time,
+            'lat': pokemon['lat'],
+            'lon': pokemon['lon'],
+            'updated': now,
+            'duration': duration,
+            'failures': 0
+        })
+        spawns.add_known(spawn_id, new_time, point, duration)
 
 
 def add_mystery_spawnpoint(session, pokemon):
     # Check if the same entry already exists
     spawn_id = pokemon['spawn_id']
     point = pokemon['lat'], pokemon['lon']
-    if point in spawns.unknown or session.query(exists().where(
-            Spawnpoint.spawn_id == spawn_id)).scalar():
+    if point in spawns.unknown or spawn_id in SPAWNPOINT_CACHE.rows:
         return
 
-    session.add(Spawnpoint(
-        spawn_id=spawn_id,
-        despawn_time=None,
-        lat=pokemon['lat'],
-        lon=pokemon['lon'],
-        updated=0,
-        duration=None,
-        failures=0
-    ))
+    row = {
+        'spawn_id': spawn_id,
+        'despawn_time': None,
+        'lat': pokemon['lat'],
+        'lon': pokemon['lon'],
+        'updated': 0,
+        'duration': None,
+        'failures': 0
+    }
+    if insert_ignore:
+        if not execute_cached(session, INSERTS[Spawnpoint.__table__], row).rowcount:
+            # it already exists, keep it so later sightings don't insert it again
+            SPAWNPOINT_CACHE.get(session, spawn_id)
+            return
+        SPAWNPOINT_CACHE.added(row)
+    elif SPAWNPOINT_CACHE.get(session, spawn_id):
+        return
+    else:
+        SPAWNPOINT_CACHE.add(session, row)
 
     if point in bounds:
         spawns.add_unknown(point)
@@ -430,104 +724,144 @@ def add_mystery(session, pokemon):
     if pokemon in MYSTERY_CACHE:
         return
     add_mystery_spawnpoint(session, pokemon)
+    spawns.add_mystery_sighting((pokemon['lat'], pokemon['lon']), pokemon['seen'])
+    if insert_ignore and execute_cached(
+            session, INSERTS[Mystery.__table__], mystery_row(pokemon)).rowcount:
+        MYSTERY_CACHE.add(pokemon)
+        return
     existing = session.query(Mystery) \
         .filter(Mystery.encounter_id == pokemon['encounter_id']) \
         .filter(Mystery.spawn_id == pokemon['spawn_id']) \
         .first()
     if existing:
-        key = combine_key(pokemon)
-        MYSTERY_CACHE.store[key] = [existing.first_seen, pokemon['seen']]
+        MYSTERY_CACHE.add(pokemon, existing.first_seen)
         return
-    seconds = pokemon['seen'] % 3600
-    obj = Mystery(
-        pokemon_id=pokemon['pokemon_id'],
-        spawn_id=pokemon['spawn_id'],
-        encounter_id=pokemon['encounter_id'],
-        lat=pokemon['lat'],
-        lon=pokemon['lon'],
-        first_seen=pokemon['seen'],
-        first_seconds=seconds,
-        last_seconds=seconds,
-        seen_range=0,
-        atk_iv=pokemon.get('individual_attack'),
-        def_iv=pokemon.get('individual_defense'),
-        sta_iv=pokemon.get('individual_stamina'),
-        move_1=pokemon.get('move_1'),
-        move_2=pokemon.get('move_2')
-    )
-    session.add(obj)
+    execute_cached(session, INSERTS[Mystery.__table__], mystery_row(pokemon))
     MYSTERY_CACHE.add(pokemon)
 
 
-def add_fort_sighting(session, raw_fort):
-    # Check if fort exists
-    fort = session.query(Fort) \
-        .filter(Fort.external_id == raw_fort['external_id']) \
-        .first()
-    if not fort:
-        fort = Fort(
-            external_id=raw_fort['external_id'],
+def mystery_row(pokemon):
+    seconds = pokemon['seen'] % 3600
+    return {
+        'pokemon_id': pokemon['pokemon_id'],
+        'spawn_id': pokemon['spawn_id'],
+        'encounter_id': pokemon['encounter_id'],
+        'lat': pokemon['lat'],
+        'lon': pokemon['lon'],
+        'first_seen': pokemon['seen'],
+        'first_seconds': seconds,
+        'last_seconds': seconds,
+        'seen_range': 0,
+        'atk_iv': pokemon.get('individual_attack'),
+        'def_iv': pokemon.get('individual_defense'),
+        'sta_iv': pokemon.get('individual_stamina'),
+        'move_1': pokemon.get('move_1'),
+        'move_2': pokemon.get('move_2')
+    }
+
+
+def add_mysteries(session, mysteries):
+    """Add a batch of mystery sightings with one query for duplicates"""
+    new = [pokemon for pokemon in mysteries if pokemon not in MYSTERY_CACHE]
+    if not new:
+        return
+    query = session.query(Mystery.encounter_id, Mystery.spawn_id, Mystery.first_seen) \
+        .filter(Mystery.encounter_id.in_({p['encounter_id'] for p in new}))
+    existing = {(encounter_id, spawn_id): first_seen
+                for encounter_id, spawn_id, first_seen in query}
+    rows = []
+    for pokemon in new:
+        # a duplicate earlier in this batch is already in the cache
+        if pokemon in MYSTERY_CACHE:
+            continue
+        add_mystery_spawnpoint(session, pokemon)
+        spawns.add_mystery_sighting((pokemon['lat'], pokemon['lon']), pokemon['seen'])
+        try:
+            MYSTERY_CACHE.add(pokemon, existing[combine_key(pokemon)])
+        except KeyError:
+            rows.append(mystery_row(pokemon))
+            MYSTERY_CACHE.add(pokemon)
+    if rows:
+        insert_rows(session, Mystery.__table__, rows)
+
+
+def get_fort_id(session, raw_fort):
+    if FORT_CACHE.ids is None:
+        FORT_CACHE.load_ids(session)
+    external_id = raw_fort['external_id']
+    try:
+        return FORT_CACHE.ids[external_id]
+    except KeyError:
+        pass
+    fort_id = session.query(Fort.id) \
+        .filter(Fort.external_id == external_id) \
+        .scalar()
+    if fort_id is None:
+        fort_id = session.execute(Fort.__table__.insert().values(
+            external_id=external_id,
             lat=raw_fort['lat'],
-            lon=raw_fort['lon'],
-        )
-        session.add(fort)
-    if fort.id and session.query(exists().where(and_(
-                FortSighting.fort_id == fort.id,
+            lon=raw_fort['lon']
+        )).inserted_primary_key[0]
+    FORT_CACHE.ids[external_id] = fort_id
+    return fort_id
+
+
+def add_fort_sighting(session, raw_fort):
+    fort_id = get_fort_id(session, raw_fort)
+    row = {
+        'fort_id': fort_id,
+        'team': raw_fort['team'],
+        'prestige': raw_fort['prestige'],
+        'guard_pokemon_id': raw_fort['guard_pokemon_id'],
+        'last_modified': raw_fort['last_modified']
+    }
+    if insert_ignore or not session.query(exists().where(and_(
+                FortSighting.fort_id == fort_id,
                 FortSighting.last_modified == raw_fort['last_modified']
             ))).scalar():
-        # Why is it not in the cache? It should be there!
-        FORT_CACHE.add(raw_fort)
-        return
-    obj = FortSighting(
-        fort=fort,
-        team=raw_fort['team'],
-        prestige=raw_fort['prestige'],
-        guard_pokemon_id=raw_fort['guard_pokemon_id'],
-        last_modified=raw_fort['last_modified'],
-    )
-    session.add(obj)
+        execute_cached(session, INSERTS[FortSighting.__table__], row)
     FORT_CACHE.add(raw_fort)
 
 
 def add_pokestop(session, raw_pokestop):
+    if FORT_CACHE.ids is None:
+        FORT_CACHE.load_ids(session)
     pokestop_id = raw_pokestop['external_id']
-    if session.query(exists().where(
-            Pokestop.external_id == pokestop_id)).scalar():
-        FORT_CACHE.pokestops.add(pokestop_id)
+    if pokestop_id in FORT_CACHE.pokestops:
         return
-
-    pokestop = Pokestop(
-        external_id=pokestop_id,
-        lat=raw_pokestop['lat'],
-        lon=raw_pokestop['lon']
-    )
-    session.add(pokestop)
+    if insert_ignore or not session.query(exists().where(
+            Pokestop.external_id == pokestop_id)).scalar():
+        execute_cached(session, INSERTS[Pokestop.__table__], {
+            'external_id': pokestop_id,
+            'lat': raw_pokestop['lat'],
+            'lon': raw_pokestop['lon']
+        })
     FORT_CACHE.pokestops.add(pokestop_id)
 
 
 def update_failures(session, spawn_id, success, allowed=conf.FAILURES_ALLOWED):
-    spawnpoint = session.query(Spawnpoint) \
-        .filter(Spawnpoint.spawn_id == spawn_id) \
-        .first()
+    spawnpoint = SPAWNPOINT_CACHE.get(session, spawn_id)
+    if not spawnpoint:
+        return
+    SPAWNPOINT_CACHE.change(spawn_id)
     try:
         if success:
-            spawnpoint.failures = 0
-        elif spawnpoint.failures >= allowed:
-            if spawnpoint.duration == 60:
-                spawnpoint.duration = None
+            spawnpoint['failures'] = 0
+        elif spawnpoint['failures'] >= allowed:
+            point = spawnpoint['lat'], spawnpoint['lon']
+            if spawnpoint['duration'] == 60:
+                spawnpoint['duration'] = None
+                spawns.add_known(spawn_id, spawnpoint['despawn_time'], point)
                 log.warning('{} consecutive failures on {}, no longer treating as an hour spawn.', allowed + 1, spawn_id)
             else:
-                spawnpoint.updated = 0
-                try:
-                    del spawns.despawn_times[spawn_id]
-                except KeyError:
-                    pass
+                spawnpoint['updated'] = 0
+                spawns.remove_known(spawn_id, point)
                 log.warning('{} consecutive failures on {}, will treat as an unknown from now on.', allowed + 1, spawn_id)
-            spawnpoint.failures = 0
+            spawnpoint['failures'] = 0
         else:
-            spawnpoint.failures += 1
+            spawnpoint['failures'] += 1
     except TypeError:
-        spawnpoint.failures = 1
+        spawnpoint['failures'] = 1
 
 
 def update_mystery(session, mystery):
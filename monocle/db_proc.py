@@ -1,24 +1,84 @@
 import sys
 
-from queue import Queue
+from abc import ABCMeta, abstractmethod
+from asyncio import sleep as async_sleep, wait
+from collections import defaultdict, deque
+from decimal import Decimal
+from os import environ
+from queue import Queue, Empty
 from threading import Thread
-from time import sleep
+from time import monotonic, sleep, time
+
+from . import bounds, db, spawns, sanitized as conf
+from .metrics import DB_ITEMS, DB_QUEUE, DB_TRANSACTION_ROWS, DB_TRANSACTION_SECONDS
+from .shared import get_logger, run_threaded, LOOP
+from .spool import Spool
+
+from sqlalchemy.exc import OperationalError
+
+
+def open_queue():
+    # shards pass their items on to the supervisor, which spools them
+    if conf.DB_SPOOL and 'MONOCLE_SHARD' not in environ:
+        return Spool()
+    return Queue()
+
+
+class CommitPolicy:
+    """Decides when the DB processor commits
+
+    A transaction is committed once it holds DB_COMMIT_ROWS items, once its
+    first item has waited DB_COMMIT_LATENCY seconds, or when the queue is
+    empty, whichever comes first.
+    """
+    def __init__(self, rows=conf.DB_COMMIT_ROWS, latency=conf.DB_COMMIT_LATENCY):
+        self.rows = rows
+        self.latency = latency
+        # items written since the last commit
+        self.pending = 0
+        self.started = None
+
+    def wrote(self, count=1):
+        if not self.pending:
+            self.started = monotonic()
+        self.pending += count
+
+    def due(self, idle):
+        return self.pending and (
+            idle or self.pending >= self.rows
+            or monotonic() - self.started >= self.latency)
+
+    def committed(self):
+        DB_TRANSACTION_ROWS.observe(self.pending)
+        DB_TRANSACTION_SECONDS.observe(monotonic() - self.started)
+        self.pending = 0
+
+    def rolled_back(self):
+        self.pending = 0
 
-from . import db
-from .shared import get_logger, LOOP
 
 class DatabaseProcessor(Thread):
 
     def __init__(self):
         super().__init__()
-        self.queue = Queue()
+        self.queue = open_queue()
+        self.spooled = isinstance(self.queue, Spool)
+        # items read again after a failure, which the caches would skip
+        self.replaying = 0
         self.log = get_logger('dbprocessor')
         self.running = True
         self.count = 0
-        self._commit = False
+        self.policy = CommitPolicy()
+        # items written since the last commit
+        self.uncommitted = []
+        # writers for each table, with DB_LANES
+        self.lanes = ()
+        # supervisor's queue to pass items to instead of writing them
+        self.remote = None
+        DB_QUEUE.callback = self.__len__
 
     def __len__(self):
-        return self.queue.qsize()
+        return self.queue.qsize() + sum(lane.queue.qsize() for lane in self.lanes)
 
     def stop(self):
         self.update_mysteries()
@@ -29,50 +89,313 @@ class DatabaseProcessor(Thread):
         self.queue.put(obj)
 
     def run(self):
-        session = db.Session()
-        LOOP.call_soon_threadsafe(self.commit)
+        if self.remote is not None:
+            self.forward()
+            return
+        # SQLite only allows one writer at a time
+        if conf.DB_LANES and db.DB_TYPE != 'sqlite':
+            self.dispatch()
+            return
+
+        session = db.WriterSession()
 
         while self.running or not self.queue.empty():
             try:
-                item = self.queue.get()
-                item_type = item['type']
+                if conf.DB_BATCH_SIZE > 1:
+                    items = self.get_batch()
+                    self.uncommitted.extend(items)
+                    keep_running = self.write_batch(session, items)
+                    self.policy.wrote(len(items))
+                    if not keep_running:
+                        break
+                else:
+                    item = self.take()
+                    if item['type'] is False:
+                        # a spool may replay the one from an unclean exit
+                        if self.running:
+                            continue
+                        break
+                    self.uncommitted.append(item)
+                    self.write(session, item)
+                    self.policy.wrote()
+                    self.log.debug('Item saved to db')
+                if self.policy.due(self.queue.empty()):
+                    self.commit(session)
+            except Exception as e:
+                self.rollback(session)
+                self.log.exception('A wild {} appeared in the DB processor!', e.__class__.__name__)
+                lost = self.uncommitted
+                self.uncommitted = []
+                if isinstance(e, OperationalError):
+                    # the database is unavailable, retry since the last commit
+                    if self.spooled:
+                        self.rewind()
+                    sleep(5.0)
+                else:
+                    self.write_each(session, lost)
+        try:
+            self.commit(session)
+        except Exception:
+            pass
+        session.close()
+
+    def commit(self, session):
+        db.SPAWNPOINT_CACHE.flush(session)
+        session.commit()
+        db.SPAWNPOINT_CACHE.committed()
+        self.uncommitted = []
+        if self.policy.pending:
+            self.policy.committed()
+        if self.spooled:
+            self.queue.ack()
+
+    def rollback(self, session):
+        session.rollback()
+        self.policy.rolled_back()
+        db.SPAWNPOINT_CACHE.rolled_back()
+        # forts inserted since the last commit are gone
+        db.FORT_CACHE.ids = None
+
+    def write_each(self, session, items):
+        """Write items one at a time, dropping those that fail
 
+        Used after a transaction fails, so that one bad item doesn't lose
+        everything else written since the last commit.
+        """
+        for item in items:
+            self.forget(item)
+        for item in items:
+            if item['type'] is False:
+                continue
+            try:
+                self.write(session, item)
+                db.SPAWNPOINT_CACHE.flush(session)
+                session.commit()
+                db.SPAWNPOINT_CACHE.committed()
+            except Exception as e:
+                self.rollback(session)
+                if isinstance(e, OperationalError):
+                    self.log.error('Lost the database while writing items one at a time.')
+                    if self.spooled:
+                        self.rewind()
+                    sleep(5.0)
+                    return
+                self.log.exception('Dropped a {} item after a {}.', item['type'], e.__class__.__name__)
+        if self.spooled:
+            self.queue.ack()
+
+    def dispatch(self):
+        """Pass items on to a writer lane for each table
+
+        A spool is acknowledged up to the oldest item that any lane hasn't
+        committed yet.
+        """
+        sightings, forts, spawnpoints = self.lanes = (
+            SightingLane(), FortLane(), SpawnpointLane())
+        for lane in self.lanes:
+            lane.start()
+        position = None
+        while self.running or not self.queue.empty():
+            try:
+                if self.spooled:
+                    position = self.queue.position()
+                item = self.take(timeout=1.0)
+                item_type = item['type']
                 if item_type == 'pokemon':
-                    db.add_sighting(session, item)
-                    self.count += 1
+                    sightings.put(item, position)
                     if not item['inferred']:
-                        db.add_spawnpoint(session, item)
+                        spawnpoints.put(item, position)
+                    self.count += 1
                 elif item_type == 'mystery':
-                    db.add_mystery(session, item)
+                    spawnpoints.put(item, position)
                     self.count += 1
-                elif item_type == 'fort':
-                    db.add_fort_sighting(session, item)
-                elif item_type == 'pokestop':
-                    db.add_pokestop(session, item)
-                elif item_type == 'target':
-                    db.update_failures(session, item['spawn_id'], item['seen'])
-                elif item_type == 'mystery-update':
-                    db.update_mystery(session, item)
-                elif item_type is False:
+                elif item_type in ('fort', 'pokestop'):
+                    forts.put(item, position)
+                elif item_type in ('target', 'mystery-update'):
+                    spawnpoints.put(item, position)
+                elif item_type is False and not self.running:
                     break
-                self.log.debug('Item saved to db')
-                if self._commit:
-                    session.commit()
-                    self._commit = False
-            except Exception as e:
-                session.rollback()
-                sleep(5.0)
-                self.log.exception('A wild {} appeared in the DB processor!', e.__class__.__name__)
+            except Empty:
+                pass
+            if self.spooled and self.queue.unacked:
+                self.ack_lanes()
+        for lane in self.lanes:
+            lane.stop()
+        for lane in self.lanes:
+            lane.join()
+        if self.spooled:
+            self.ack_lanes()
+
+    def ack_lanes(self):
+        """Acknowledge the spool up to the oldest uncommitted item of any lane"""
+        oldest = [position for position in (lane.oldest() for lane in self.lanes)
+                  if position is not None]
+        # nothing else reads from the spool, so it's where the next item is
+        position = min(oldest) if oldest else self.queue.position()
+        if position[:2] != self.queue.acked:
+            self.queue.ack(position)
+
+    def take(self, block=True, timeout=None):
+        item = self.queue.get(block, timeout)
+        if self.replaying:
+            self.replaying -= 1
+            self.forget(item)
+        return item
+
+    def rewind(self):
+        self.replaying += self.queue.unacked
+        self.queue.rewind()
+
+    @staticmethod
+    def forget(item):
+        """Remove an item that is being written again from the caches"""
+        item_type = item['type']
+        if item_type == 'pokemon':
+            db.SIGHTING_CACHE.remove(item['spawn_id'])
+            spawns.despawn_times.pop(item['spawn_id'], None)
+        elif item_type == 'mystery':
+            db.MYSTERY_CACHE.store.pop(db.combine_key(item), None)
+        elif item_type == 'pokestop':
+            db.FORT_CACHE.pokestops.discard(item['external_id'])
+
+    def write(self, session, item):
+        item_type = item['type']
+        if item_type == 'pokemon':
+            db.add_sighting(session, item)
+            self.count += 1
+            if not item['inferred']:
+                db.add_spawnpoint(session, item)
+        elif item_type == 'mystery':
+            db.add_mystery(session, item)
+            self.count += 1
+        elif item_type == 'fort':
+            db.add_fort_sighting(session, item)
+        elif item_type == 'pokestop':
+            db.add_pokestop(session, item)
+        elif item_type == 'target':
+            db.update_failures(session, item['spawn_id'], item['seen'])
+        elif item_type == 'mystery-update':
+            db.update_mystery(session, item)
+        DB_ITEMS.inc(item_type)
+
+    def get_batch(self, size=conf.DB_BATCH_SIZE, wait=conf.DB_BATCH_WAIT):
+        """Get up to size items, waiting at most wait seconds after the first"""
+        items = [self.take()]
+        deadline = monotonic() + wait
         try:
-            session.commit()
-        except Exception:
+            while len(items) < size:
+                remaining = deadline - monotonic()
+                if remaining > 0:
+                    items.append(self.take(timeout=remaining))
+                else:
+                    items.append(self.take(False))
+        except Empty:
             pass
-        session.close()
+        return items
+
+    def write_batch(self, session, items):
+        """Write items grouped by type, sightings with multi-row INSERTs
+
+        Returns False if the stop item was among them.
+        """
+        groups = defaultdict(list)
+        for item in items:
+            groups[item['type']].append(item)
+        # a spool may replay the stop item from an unclean exit
+        keep_running = groups.pop(False, None) is None or self.running
+
+        sightings = groups.pop('pokemon', ())
+        if sightings:
+            db.add_sightings(session, sightings)
+            for item in sightings:
+                if not item['inferred']:
+                    db.add_spawnpoint(session, item)
+            self.count += len(sightings)
+            DB_ITEMS.inc('pokemon', amount=len(sightings))
+        mysteries = groups.pop('mystery', ())
+        if mysteries:
+            db.add_mysteries(session, mysteries)
+            self.count += len(mysteries)
+            DB_ITEMS.inc('mystery', amount=len(mysteries))
+        # spawnpoints and mysteries have to exist before these update them
+        for item_type in ('fort', 'pokestop', 'target', 'mystery-update'):
+            for item in groups.pop(item_type, ()):
+                self.write(session, item)
+        self.log.debug('{} items saved to db', len(items))
+        return keep_running
+
+    def forward(self, batch_size=500):
+        """Pass items on to the supervisor's processor in batches"""
+        while self.running or not self.queue.empty():
+            items = [self.queue.get()]
+            try:
+                while len(items) < batch_size:
+                    items.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            items = self.remember(items)
+            if not items:
+                continue
+            try:
+                self.remote.put(items)
+            except Exception as e:
+                self.log.exception('A wild {} appeared while forwarding DB items!', e.__class__.__name__)
+                sleep(5.0)
+
+    def remember(self, items):
+        """Update the caches and spawns as writing items would
+
+        Used by shards, whose items are written by the supervisor. Returns
+        the items that need to be forwarded.
+        """
+        forwarded = []
+        for item in items:
+            item_type = item['type']
+            if item_type == 'pokemon':
+                db.SIGHTING_CACHE.add(item)
+                spawn_id = item['spawn_id']
+                despawn_time = item['expire_timestamp'] % 3600
+                if not item['inferred'] and spawns.despawn_times.get(spawn_id) != despawn_time:
+                    # the duration of hour spawns comes with the next spawn update
+                    spawns.add_known(spawn_id, despawn_time, (item['lat'], item['lon']))
+                self.count += 1
+            elif item_type == 'mystery':
+                if item not in db.MYSTERY_CACHE:
+                    point = item['lat'], item['lon']
+                    if (point not in spawns.unknown and point in bounds
+                            and item['spawn_id'] not in spawns.despawn_times):
+                        spawns.add_unknown(point)
+                    spawns.add_mystery_sighting(point, item['seen'])
+                    db.MYSTERY_CACHE.add(item)
+                self.count += 1
+            elif item_type == 'fort':
+                db.FORT_CACHE.add(item)
+            elif item_type == 'pokestop':
+                db.FORT_CACHE.pokestops.add(item['external_id'])
+            elif item_type is False or item_type == 'mystery-update':
+                # the supervisor's own cache sees every mystery and updates them
+                continue
+            forwarded.append(item)
+        return forwarded
 
-    def commit(self):
-        self._commit = True
-        if self.running:
-            LOOP.call_later(5, self.commit)
+    def receive(self, remote, accounts):
+        """Add items forwarded by shard processes until None is received
+
+        Accounts sent by shards as they exit are merged into accounts,
+        keeping whichever copy was used most recently.
+        """
+        while True:
+            items = remote.get()
+            if items is None:
+                break
+            for item in items:
+                if item['type'] == 'accounts':
+                    for username, account in item['accounts'].items():
+                        current = accounts.get(username)
+                        if current is None or account.get('time', 0) >= current.get('time', 0):
+                            accounts[username] = account
+                else:
+                    self.add(item)
 
     def update_mysteries(self):
        for key, times in db.MYSTERY_CACHE.items():
@@ -88,4 +411,589 @@ class DatabaseProcessor(Thread):
                }
                self.add(mystery)
 
-sys.modules[__name__] = DatabaseProcessor()
+
+class WriterLane(Thread, metaclass=ABCMeta):
+    """Writes some types of items with its own connection and transactions
+
+    Items are written in the order they were put. Those not yet committed
+    are written again if the database is unavailable.
+    """
+    kind = None
+
+    def __init__(self):
+        super().__init__(name='db-' + self.kind)
+        self.queue = Queue()
+        self.log = get_logger('db-' + self.kind)
+        self.policy = CommitPolicy()
+        # spool positions of the items put but not yet committed or dropped
+        self.positions = deque()
+
+    def put(self, item, position=None):
+        self.positions.append(position)
+        self.queue.put(item)
+
+    def oldest(self):
+        """Spool position of the oldest item not yet committed, or None"""
+        try:
+            return self.positions[0]
+        except IndexError:
+            return None
+
+    def finished(self, count):
+        for _ in range(count):
+            self.positions.popleft()
+
+    def stop(self):
+        self.queue.put(None)
+
+    def take(self, block=True, timeout=None):
+        return self.queue.get(block, timeout)
+
+    get_batch = DatabaseProcessor.get_batch
+
+    def run(self):
+        session = db.Session()
+        size = max(conf.DB_BATCH_SIZE, 100)
+        wait = conf.DB_BATCH_WAIT if conf.DB_BATCH_SIZE > 1 else 0
+        # items written since the last commit, and those to write again
+        pending = []
+        retry = []
+        running = True
+        while running:
+            items = self.get_batch(size, wait)
+            if None in items:
+                running = False
+                items = [item for item in items if item is not None]
+            items = retry + items
+            retry = []
+            pending.extend(items)
+            try:
+                if items:
+                    self.write(session, items)
+                    self.policy.wrote(len(items))
+                if pending and (not running or self.policy.due(self.queue.empty())):
+                    self.flush(session)
+                    session.commit()
+                    self.committed()
+                    self.policy.committed()
+                    self.finished(len(pending))
+                    pending = []
+            except Exception as e:
+                session.rollback()
+                self.policy.rolled_back()
+                self.rolled_back()
+                lost = pending
+                pending = []
+                self.log.exception('A wild {} appeared in the {} writer!', e.__class__.__name__, self.kind)
+                for item in lost:
+                    self.forget(item)
+                if not isinstance(e, OperationalError):
+                    # one bad item shouldn't lose the others
+                    lost = self.write_each(session, lost)
+                if running and lost:
+                    # the database is unavailable, retry since the last commit
+                    retry = lost
+                    sleep(5.0)
+                elif lost:
+                    # their positions hold back the spool's last ack, so
+                    # they're written again on the next start
+                    self.log.error('Lost the database while stopping, {} items were not written.', len(lost))
+        session.close()
+
+    def write_each(self, session, items):
+        """Commit items one at a time, dropping those that fail
+
+        Returns the items that weren't tried because the database became
+        unavailable.
+        """
+        for i, item in enumerate(items):
+            try:
+                self.write(session, [item])
+                self.flush(session)
+                session.commit()
+                self.committed()
+            except Exception as e:
+                session.rollback()
+                self.rolled_back()
+                if isinstance(e, OperationalError):
+                    return items[i:]
+                self.log.exception('Dropped a {} item after a {}.', item['type'], e.__class__.__name__)
+            self.finished(1)
+        return []
+
+    @abstractmethod
+    def write(self, session, items):
+        """Write items without committing them"""
+
+    def forget(self, item):
+        """Remove an item that will be written again from this lane's caches"""
+
+    def flush(self, session):
+        pass
+
+    def committed(self):
+        pass
+
+    def rolled_back(self):
+        pass
+
+
+class SightingLane(WriterLane):
+    kind = 'sightings'
+
+    def write(self, session, items):
+        db.add_sightings(session, items)
+        DB_ITEMS.inc('pokemon', amount=len(items))
+
+    def forget(self, item):
+        db.SIGHTING_CACHE.remove(item['spawn_id'])
+
+
+class FortLane(WriterLane):
+    kind = 'forts'
+
+    def write(self, session, items):
+        for item in items:
+            if item['type'] == 'fort':
+                db.add_fort_sighting(session, item)
+            else:
+                db.add_pokestop(session, item)
+            DB_ITEMS.inc(item['type'])
+
+    def forget(self, item):
+        if item['type'] == 'pokestop':
+            db.FORT_CACHE.pokestops.discard(item['external_id'])
+
+    def rolled_back(self):
+        # forts inserted since the last commit are gone
+        db.FORT_CACHE.ids = None
+
+
+class SpawnpointLane(WriterLane):
+    """Mysteries and their updates, spawnpoints of sightings and target failures
+
+    Spawnpoints of sightings are checked for hour spawns against the
+    mysteries seen there, so they share a lane and the mysteries of a batch
+    are written first. The only lane that uses SPAWNPOINT_CACHE.
+    """
+    kind = 'spawnpoints'
+
+    def write(self, session, items):
+        mysteries = [item for item in items if item['type'] == 'mystery']
+        if mysteries:
+            db.add_mysteries(session, mysteries)
+            DB_ITEMS.inc('mystery', amount=len(mysteries))
+        for item in items:
+            item_type = item['type']
+            if item_type == 'mystery-update':
+                db.update_mystery(session, item)
+                DB_ITEMS.inc(item_type)
+        for item in items:
+            item_type = item['type']
+            if item_type == 'pokemon':
+                db.add_spawnpoint(session, item)
+            elif item_type == 'target':
+                db.update_failures(session, item['spawn_id'], item['seen'])
+                DB_ITEMS.inc(item_type)
+
+    def forget(self, item):
+        if item['type'] == 'pokemon':
+            spawns.despawn_times.pop(item['spawn_id'], None)
+        elif item['type'] == 'mystery':
+            db.MYSTERY_CACHE.store.pop(db.combine_key(item), None)
+
+    def flush(self, session):
+        db.SPAWNPOINT_CACHE.flush(session)
+
+    def committed(self):
+        db.SPAWNPOINT_CACHE.committed()
+
+    def rolled_back(self):
+        db.SPAWNPOINT_CACHE.rolled_back()
+
+
+class AsyncDatabaseProcessor:
+    """Writes items to PostgreSQL from the event loop with asyncpg
+
+    Whatever was queued since the last write is written in one transaction,
+    up to DB_BATCH_SIZE (but at least 100) items at a time. asyncpg
+    prepares each statement once per pooled connection, and rows that need
+    no result are sent together with executemany.
+    """
+    INSERT_SIGHTING = '''
+        INSERT INTO sightings (pokemon_id, spawn_id, encounter_id,
+            expire_timestamp, lat, lon, atk_iv, def_iv, sta_iv, move_1, move_2)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+        ON CONFLICT DO NOTHING
+    '''
+    # duration is 60 for hour-long spawns, which are assumed if a mystery
+    # was seen there for more than half an hour
+    UPSERT_SPAWNPOINT = '''
+        INSERT INTO spawnpoints (spawn_id, despawn_time, lat, lon, updated,
+            duration, failures)
+        VALUES ($1, $2, $3, $4, $5, (
+            SELECT CASE WHEN MAX(seen_range) > 1800 THEN 60 END
+            FROM mystery_sightings WHERE spawn_id = $1 AND first_seen > $6
+        ), 0)
+        ON CONFLICT (spawn_id) DO UPDATE SET
+            despawn_time = EXCLUDED.despawn_time,
+            updated = EXCLUDED.updated,
+            failures = 0,
+            duration = CASE WHEN spawnpoints.despawn_time IS NULL
+                THEN COALESCE(EXCLUDED.duration, spawnpoints.duration)
+                ELSE spawnpoints.duration END
+    '''
+    GET_DURATIONS = 'SELECT spawn_id, duration FROM spawnpoints WHERE spawn_id = ANY($1)'
+    REFRESH_SPAWNPOINT = 'UPDATE spawnpoints SET updated = $2, failures = 0 WHERE spawn_id = $1'
+    INSERT_MYSTERY_SPAWNPOINT = '''
+        INSERT INTO spawnpoints (spawn_id, lat, lon, updated, failures)
+        VALUES ($1, $2, $3, 0, 0)
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    '''
+    INSERT_MYSTERY = '''
+        INSERT INTO mystery_sightings (pokemon_id, spawn_id, encounter_id,
+            lat, lon, first_seen, first_seconds, last_seconds, seen_range,
+            atk_iv, def_iv, sta_iv, move_1, move_2)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $7, 0, $8, $9, $10, $11, $12)
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    '''
+    GET_FIRST_SEEN = '''
+        SELECT first_seen FROM mystery_sightings
+        WHERE encounter_id = $1 AND spawn_id = $2
+    '''
+    # the outer INSERT can't see the fort inserted by the CTE, but gets its
+    # id from RETURNING instead. Parameters in a SELECT need explicit types.
+    INSERT_FORT_SIGHTING = '''
+        WITH new_fort AS (
+            INSERT INTO forts (external_id, lat, lon) VALUES ($1, $2, $3)
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        )
+        INSERT INTO fort_sightings (fort_id, team, prestige,
+            guard_pokemon_id, last_modified)
+        SELECT id, $4::smallint, $5::integer, $6::smallint, $7::integer FROM (
+            SELECT id FROM new_fort
+            UNION ALL
+            SELECT id FROM forts WHERE external_id = $1
+        ) AS fort LIMIT 1
+        ON CONFLICT DO NOTHING
+    '''
+    INSERT_POKESTOP = '''
+        INSERT INTO pokestops (external_id, lat, lon) VALUES ($1, $2, $3)
+        ON CONFLICT DO NOTHING
+    '''
+    RESET_FAILURES = 'UPDATE spawnpoints SET failures = 0 WHERE spawn_id = $1'
+    GET_SPAWNPOINT = '''
+        SELECT despawn_time, lat, lon, updated, duration, failures
+        FROM spawnpoints WHERE spawn_id = $1
+    '''
+    UPDATE_FAILURES = '''
+        UPDATE spawnpoints SET failures = $2, duration = $3, updated = $4
+        WHERE spawn_id = $1
+    '''
+    UPDATE_MYSTERY = '''
+        UPDATE mystery_sightings SET
+            last_seconds = $3 - (first_seen - first_seen % 3600),
+            seen_range = $3 - $4
+        WHERE spawn_id = $1 AND encounter_id = $2
+    '''
+
+    def __init__(self):
+        if not conf.DB_ENGINE.startswith('postgres'):
+            raise ValueError('DB_ASYNC requires a PostgreSQL DB_ENGINE.')
+        self.queue = open_queue()
+        self.spooled = isinstance(self.queue, Spool)
+        # items read again after a failure, which the caches would skip
+        self.replaying = 0
+        self.log = get_logger('dbprocessor')
+        self.running = True
+        self.count = 0
+        self.pool = None
+        # items of a failed transaction to write again, without a spool
+        self.retry = []
+        # supervisor's queue to pass items to instead of writing them
+        self.remote = None
+        # resolved once everything queued before stopping has been written
+        self.finished = None
+        DB_QUEUE.callback = self.__len__
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        self.update_mysteries()
+        self.running = False
+
+    def add(self, obj):
+        self.queue.put(obj)
+
+    def start(self):
+        self.finished = LOOP.create_future()
+        LOOP.create_task(self.connect())
+
+    def join(self, timeout=None):
+        """Run the event loop until the queue is written or timeout passes"""
+        if not self.finished.done():
+            LOOP.run_until_complete(wait((self.finished,), timeout=timeout, loop=LOOP))
+
+    receive = DatabaseProcessor.receive
+    remember = DatabaseProcessor.remember
+    update_mysteries = DatabaseProcessor.update_mysteries
+    take = DatabaseProcessor.take
+    rewind = DatabaseProcessor.rewind
+    forget = DatabaseProcessor.forget
+
+    async def connect(self):
+        while self.remote is None and self.pool is None:
+            try:
+                self.pool = await create_pool(**conf.DB, loop=LOOP)
+            except (OSError, PostgresConnectionError) as e:
+                self.log.error('{} while connecting to the database, retrying.', e.__class__.__name__)
+                await async_sleep(5.0, loop=LOOP)
+        self.flush()
+
+    def flush(self, size=max(conf.DB_BATCH_SIZE, 100), delay=conf.DB_BATCH_WAIT):
+        """Start writing whatever is queued, or check again after delay"""
+        items = self.retry
+        self.retry = []
+        try:
+            while len(items) < size:
+                items.append(self.take(False))
+        except Empty:
+            pass
+        if items:
+            LOOP.create_task(self.write_batch(items))
+        elif self.running:
+            LOOP.call_later(delay, self.flush)
+        else:
+            LOOP.create_task(self.close())
+
+    async def write_batch(self, items):
+        try:
+            if self.remote is not None:
+                items = self.remember(items)
+                if items:
+                    await run_threaded(self.remote.put, items)
+            else:
+                started = monotonic()
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await self.write(conn, items)
+                DB_TRANSACTION_ROWS.observe(len(items))
+                DB_TRANSACTION_SECONDS.observe(monotonic() - started)
+                if self.spooled:
+                    self.queue.ack()
+                self.log.debug('{} items saved to db', len(items))
+        except Exception as e:
+            self.log.exception('A wild {} appeared in the DB processor!', e.__class__.__name__)
+            if self.remote is not None:
+                self.log.error('Dropped {} items that could not be forwarded.', len(items))
+                LOOP.call_later(5.0, self.flush)
+                return
+            for item in items:
+                self.forget(item)
+            if not isinstance(e, (OSError, PostgresConnectionError, InterfaceError)):
+                # one bad item shouldn't lose the others
+                items = await self.write_each(items)
+            if items:
+                # the database is unavailable, write the items again
+                if self.spooled:
+                    self.rewind()
+                else:
+                    self.retry = items
+                LOOP.call_later(5.0, self.flush)
+                return
+            if self.spooled:
+                self.queue.ack()
+        self.flush()
+
+    async def write_each(self, items):
+        """Write items in a transaction each, dropping those that fail
+
+        Returns the items that weren't written because the database became
+        unavailable.
+        """
+        for i, item in enumerate(items):
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await self.write(conn, [item])
+            except Exception as e:
+                self.forget(item)
+                if isinstance(e, (OSError, PostgresConnectionError, InterfaceError)):
+                    self.log.error('Lost the database while writing items one at a time.')
+                    return items[i:]
+                self.log.exception('Dropped a {} item after a {}.', item['type'], e.__class__.__name__)
+        return []
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+        self.finished.set_result(None)
+
+    async def write(self, conn, items):
+        groups = defaultdict(list)
+        for item in items:
+            groups[item['type']].append(item)
+        for item_type, group in groups.items():
+            DB_ITEMS.inc(item_type, amount=len(group))
+
+        sightings = [pokemon for pokemon in groups['pokemon']
+                     if pokemon not in db.SIGHTING_CACHE]
+        if sightings:
+            await conn.executemany(self.INSERT_SIGHTING, [(
+                pokemon['pokemon_id'],
+                pokemon['spawn_id'],
+                Decimal(pokemon['encounter_id']),
+                pokemon['expire_timestamp'],
+                pokemon['lat'],
+                pokemon['lon'],
+                pokemon.get('individual_attack'),
+                pokemon.get('individual_defense'),
+                pokemon.get('individual_stamina'),
+                pokemon.get('move_1'),
+                pokemon.get('move_2')) for pokemon in sightings])
+            for pokemon in sightings:
+                db.SIGHTING_CACHE.add(pokemon)
+        await self.add_spawnpoints(conn, [pokemon for pokemon in groups['pokemon']
+                                          if not pokemon['inferred']])
+        self.count += len(groups['pokemon'])
+
+        for pokemon in groups['mystery']:
+            await self.add_mystery(conn, pokemon)
+        self.count += len(groups['mystery'])
+
+        if groups['fort']:
+            await conn.executemany(self.INSERT_FORT_SIGHTING, [(
+                fort['external_id'],
+                fort['lat'],
+                fort['lon'],
+                fort['team'],
+                fort['prestige'],
+                fort['guard_pokemon_id'],
+                fort['last_modified']) for fort in groups['fort']])
+            for fort in groups['fort']:
+                db.FORT_CACHE.add(fort)
+        if groups['pokestop']:
+            await conn.executemany(self.INSERT_POKESTOP, [(
+                pokestop['external_id'],
+                pokestop['lat'],
+                pokestop['lon']) for pokestop in groups['pokestop']])
+            for pokestop in groups['pokestop']:
+                db.FORT_CACHE.pokestops.add(pokestop['external_id'])
+
+        successes = [(item['spawn_id'],) for item in groups['target'] if item['seen']]
+        if successes:
+            await conn.executemany(self.RESET_FAILURES, successes)
+        for item in groups['target']:
+            if not item['seen']:
+                await self.add_failure(conn, item['spawn_id'])
+
+        if groups['mystery-update']:
+            await conn.executemany(self.UPDATE_MYSTERY, [(
+                mystery['spawn'],
+                Decimal(mystery['encounter']),
+                mystery['last'],
+                mystery['first']) for mystery in groups['mystery-update']])
+
+    async def add_spawnpoints(self, conn, sightings):
+        """Upsert the spawnpoints of sightings with a round trip per statement
+
+        Spawnpoints whose despawn time is already known only have updated
+        and failures refreshed.
+        """
+        # {spawn_id: latest sighting} of spawnpoints with a new despawn time
+        changed = {}
+        unchanged = set()
+        for pokemon in sightings:
+            spawn_id = pokemon['spawn_id']
+            if (spawn_id not in changed and pokemon['expire_timestamp'] % 3600
+                    == spawns.despawn_times.get(spawn_id)):
+                unchanged.add(spawn_id)
+            else:
+                changed[spawn_id] = pokemon
+        now = round(time())
+        if unchanged:
+            await conn.executemany(self.REFRESH_SPAWNPOINT,
+                                   [(spawn_id, now) for spawn_id in unchanged])
+        if not changed:
+            return
+        last_migration = int(conf.LAST_MIGRATION)
+        await conn.executemany(self.UPSERT_SPAWNPOINT, [(
+            spawn_id,
+            pokemon['expire_timestamp'] % 3600,
+            pokemon['lat'],
+            pokemon['lon'],
+            now,
+            last_migration) for spawn_id, pokemon in changed.items()])
+        durations = {record['spawn_id']: record['duration'] for record in
+                     await conn.fetch(self.GET_DURATIONS, list(changed))}
+        for spawn_id, pokemon in changed.items():
+            spawns.add_known(spawn_id, pokemon['expire_timestamp'] % 3600,
+                             (pokemon['lat'], pokemon['lon']), durations.get(spawn_id))
+
+    async def add_mystery(self, conn, pokemon):
+        if pokemon in db.MYSTERY_CACHE:
+            return
+        spawn_id = pokemon['spawn_id']
+        point = pokemon['lat'], pokemon['lon']
+        if point not in spawns.unknown and await conn.fetchval(
+                self.INSERT_MYSTERY_SPAWNPOINT, spawn_id, *point) and point in bounds:
+            spawns.add_unknown(point)
+        spawns.add_mystery_sighting(point, pokemon['seen'])
+
+        encounter_id = Decimal(pokemon['encounter_id'])
+        if await conn.fetchval(
+                self.INSERT_MYSTERY,
+                pokemon['pokemon_id'],
+                spawn_id,
+                encounter_id,
+                pokemon['lat'],
+                pokemon['lon'],
+                pokemon['seen'],
+                pokemon['seen'] % 3600,
+                pokemon.get('individual_attack'),
+                pokemon.get('individual_defense'),
+                pokemon.get('individual_stamina'),
+                pokemon.get('move_1'),
+                pokemon.get('move_2')):
+            db.MYSTERY_CACHE.add(pokemon)
+        else:
+            first_seen = await conn.fetchval(self.GET_FIRST_SEEN, encounter_id, spawn_id)
+            db.MYSTERY_CACHE.add(pokemon, first_seen)
+
+    async def add_failure(self, conn, spawn_id, allowed=conf.FAILURES_ALLOWED):
+        spawnpoint = await conn.fetchrow(self.GET_SPAWNPOINT, spawn_id)
+        if not spawnpoint:
+            return
+        failures = spawnpoint['failures']
+        duration = spawnpoint['duration']
+        updated = spawnpoint['updated']
+        if failures is None:
+            failures = 1
+        elif failures >= allowed:
+            point = spawnpoint['lat'], spawnpoint['lon']
+            if duration == 60:
+                duration = None
+                spawns.add_known(spawn_id, spawnpoint['despawn_time'], point)
+                self.log.warning('{} consecutive failures on {}, no longer treating as an hour spawn.', allowed + 1, spawn_id)
+            else:
+                updated = 0
+                spawns.remove_known(spawn_id, point)
+                self.log.warning('{} consecutive failures on {}, will treat as an unknown from now on.', allowed + 1, spawn_id)
+            failures = 0
+        else:
+            failures += 1
+        await conn.execute(self.UPDATE_FAILURES, spawn_id, failures, duration, updated)
+
+
+if conf.DB_ASYNC:
+    try:
+        from asyncpg import create_pool, InterfaceError, PostgresConnectionError
+    except ImportError as e:
+        raise ImportError('DB_ASYNC is set but asyncpg is not available.') from e
+    sys.modules[__name__] = AsyncDatabaseProcessor()
+else:
+    sys.modules[__name__] = DatabaseProcessor()
@@ -0,0 +1,110 @@
+from array import array
+from collections import defaultdict
+from math import floor, sqrt
+from mmap import mmap, ACCESS_READ
+from os.path import join
+from sys import byteorder
+
+# SRTM's value for points without data
+VOID = -32768
+
+
+def tile_name(lat, lon):
+    return '{}{:02d}{}{:03d}.hgt'.format(
+        'N' if lat >= 0 else 'S', abs(lat), 'E' if lon >= 0 else 'W', abs(lon))
+
+
+class HgtTiles:
+    """Elevations from SRTM .hgt tiles in a directory
+
+    Each tile covers one degree from the named south-west corner, as rows of
+    big-endian 16-bit integers from north to south, 1201 or 3601 to a side.
+    Tiles are memory-mapped as they're needed, and those that aren't a
+    square of samples are skipped.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        # {(lat, lon): (mapped file, side) or None}
+        self.tiles = {}
+
+    def tile(self, key):
+        try:
+            return self.tiles[key]
+        except KeyError:
+            pass
+        tile = None
+        try:
+            with open(join(self.directory, tile_name(*key)), 'rb') as f:
+                mapped = mmap(f.fileno(), 0, access=ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            pass
+        else:
+            side = round(sqrt(len(mapped) // 2))
+            if side > 1 and side * side * 2 == len(mapped):
+                tile = mapped, side
+            else:
+                mapped.close()
+        self.tiles[key] = tile
+        return tile
+
+    @staticmethod
+    def cell(key, side, point):
+        """Row and column of the tile's sample nearest to point"""
+        return (round((key[0] + 1 - point[0]) * (side - 1)),
+                round((point[1] - key[1]) * (side - 1)))
+
+    @staticmethod
+    def rows(mapped, side, first, stop):
+        """Decode the samples of rows first to stop as native integers"""
+        values = array('h', mapped[first * side * 2:stop * side * 2])
+        if byteorder == 'little':
+            values.byteswap()
+        return values
+
+    def elevation(self, point):
+        """The elevation nearest to point, or None if it's unknown"""
+        key = floor(point[0]), floor(point[1])
+        tile = self.tile(key)
+        if tile is None:
+            return None
+        mapped, side = tile
+        row, column = self.cell(key, side, point)
+        offset = (row * side + column) * 2
+        value = int.from_bytes(mapped[offset:offset + 2], 'big', signed=True)
+        return None if value == VOID else value
+
+    def fill(self, grid, points):
+        """Set the grid's altitude of each point that has data
+
+        The rows each tile's points fall in are decoded together, and the
+        altitudes written to the grid at once. Returns the points that are
+        still unknown.
+        """
+        by_tile = defaultdict(list)
+        for point in points:
+            by_tile[floor(point[0]), floor(point[1])].append(point)
+        altitudes = {}
+        missing = []
+        for key, tile_points in by_tile.items():
+            tile = self.tile(key)
+            if tile is None:
+                missing.extend(tile_points)
+                continue
+            mapped, side = tile
+            cells = [self.cell(key, side, point) for point in tile_points]
+            first = min(row for row, _ in cells)
+            values = self.rows(mapped, side, first, max(row for row, _ in cells) + 1)
+            for point, (row, column) in zip(tile_points, cells):
+                value = values[(row - first) * side + column]
+                if value == VOID:
+                    missing.append(point)
+                else:
+                    altitudes[point] = value
+        grid.update(altitudes)
+        return missing
+
+    def close(self):
+        for tile in self.tiles.values():
+            if tile is not None:
+                tile[0].close()
+        self.tiles.clear()
@@ -0,0 +1,212 @@
+from bisect import bisect_left, insort
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import time
+
+from . import sanitized as conf
+from .shared import LOOP
+
+
+class JobQueue:
+    """Prioritized points for long-lived worker loops to pull from
+
+    Known spawns come before unknown points, earliest first. A posted point
+    goes straight to the fastest idle worker that can reach it, otherwise it
+    stays queued until a worker finishing a visit pulls it, or until the
+    soonest time an idle worker will be able to reach it. Points that wait
+    longer than GIVE_UP_KNOWN or GIVE_UP_UNKNOWN are dropped.
+
+    That time is found for each job when it's queued, and brought forward
+    when a worker that could reach it sooner becomes idle. A single timer is
+    kept for the soonest of them.
+    """
+    def __init__(self, index, on_expire, limit=conf.COROUTINES_LIMIT,
+                 speed_limit=conf.SPEED_LIMIT):
+        self.index = index
+        self.on_expire = on_expire
+        self.limit = limit
+        self.speed_limit = speed_limit
+        self.counter = count()
+        # sorted [((rank, time), number, point, spawn_time, spawn_id, give_up)]
+        self.pending = []
+        # {worker: future} of worker loops waiting for a job
+        self.waiting = {}
+        # {worker: job} handed to workers before their loop asked for one
+        self.ready = {}
+        # {number: time} at which each pending job may be reachable or expires
+        self.wakes = {}
+        # heap of [(time, number, job)], may hold stale entries
+        self.timers = []
+        # resolved when there is room for more pending jobs
+        self.room = None
+        self.handle = None
+        # when the handle will call assign
+        self.handle_time = None
+        self.running = True
+
+    def __len__(self):
+        return len(self.pending)
+
+    async def post(self, point, spawn_time=None, spawn_id=None):
+        """Queue a point, waiting while the queue is full"""
+        while len(self.pending) >= self.limit and self.running:
+            if self.room is None or self.room.done():
+                self.room = LOOP.create_future()
+            await self.room
+        if not self.running:
+            return
+        now = time()
+        if spawn_time:
+            job = (0, spawn_time), next(self.counter), point, spawn_time, spawn_id, now + conf.GIVE_UP_KNOWN
+        else:
+            job = (1, now), next(self.counter), point, None, None, now + conf.GIVE_UP_UNKNOWN
+
+        worker, speed = self.index.best(point)
+        if worker:
+            worker.speed = speed
+            self.give(worker, job)
+        else:
+            insort(self.pending, job)
+            self.arm(job, self.index.earliest(point, self.speed_limit))
+            self.rearm()
+
+    async def take(self, worker):
+        """Returns the next job for an idle worker, or None once closed"""
+        try:
+            return self.ready.pop(worker)
+        except KeyError:
+            pass
+        if not self.running:
+            return None
+
+        job = self.pull(worker)
+        if job:
+            return job
+        # it may be able to reach some jobs sooner than the other workers
+        for job in self.pending:
+            self.arm(job, self.index.reachable(worker, job[2], self.speed_limit))
+        self.rearm()
+        future = self.waiting[worker] = LOOP.create_future()
+        try:
+            return await future
+        finally:
+            self.waiting.pop(worker, None)
+
+    def pull(self, worker):
+        """Remove and return the first pending job that worker can reach"""
+        now = time()
+        pending = self.pending
+        expired = []
+        job = None
+        for i, candidate in enumerate(pending):
+            if candidate[5] < now:
+                expired.append(i)
+                continue
+            speed = worker.travel_speed(candidate[2])
+            if speed < self.speed_limit:
+                worker.speed = speed
+                job = candidate
+                expired.append(i)
+                break
+        for i in reversed(expired):
+            removed = pending.pop(i)
+            self.wakes.pop(removed[1], None)
+            if removed is not job:
+                self.on_expire(removed)
+        if expired:
+            self.made_room()
+        return job
+
+    def give(self, worker, job):
+        # keep the worker from being chosen again before its loop resumes
+        self.index.remove(worker)
+        future = self.waiting.pop(worker, None)
+        if future and not future.done():
+            future.set_result(job)
+        else:
+            self.ready[worker] = job
+
+    def assign(self):
+        """Hand jobs that may now be reachable to idle workers, drop expired ones"""
+        self.handle = None
+        now = time()
+        timers = self.timers
+        due = []
+        while timers and timers[0][0] <= now:
+            when, number, job = heappop(timers)
+            if self.wakes.get(number) == when:
+                del self.wakes[number]
+                due.append(job)
+        due.sort()
+        removed = False
+        for job in due:
+            if job[5] < now:
+                self.discard(job)
+                self.on_expire(job)
+                removed = True
+                continue
+            worker, speed = self.index.best(job[2])
+            if worker:
+                worker.speed = speed
+                self.discard(job)
+                self.give(worker, job)
+                removed = True
+            else:
+                self.arm(job, self.index.earliest(job[2], self.speed_limit))
+        if removed:
+            self.made_room()
+        self.rearm()
+
+    def discard(self, job):
+        pending = self.pending
+        i = bisect_left(pending, job)
+        if i < len(pending) and pending[i] is job:
+            del pending[i]
+
+    def arm(self, job, when):
+        """Check on a job at when, if that's sooner than it would be"""
+        if when is None or when > job[5]:
+            when = job[5]
+        number = job[1]
+        current = self.wakes.get(number)
+        if current is None or when < current:
+            self.wakes[number] = when
+            heappush(self.timers, (when, number, job))
+
+    def rearm(self):
+        """Keep the timer for the soonest job to check on"""
+        timers = self.timers
+        wakes = self.wakes
+        if len(timers) > 4 * len(wakes) + 64:
+            self.timers = timers = [x for x in timers if wakes.get(x[1]) == x[0]]
+            heapify(timers)
+        while timers and wakes.get(timers[0][1]) != timers[0][0]:
+            heappop(timers)
+        if not timers or not self.running:
+            if self.handle:
+                self.handle.cancel()
+                self.handle = None
+            return
+        when = timers[0][0]
+        if self.handle:
+            if self.handle_time <= when:
+                return
+            self.handle.cancel()
+        self.handle_time = when
+        # at least a short delay, in case rounding makes it look reachable now
+        self.handle = LOOP.call_later(max(when - time(), 0.1), self.assign)
+
+    def made_room(self):
+        if self.room and not self.room.done() and len(self.pending) < self.limit:
+            self.room.set_result(None)
+
+    def close(self):
+        """Release every waiting worker loop and poster"""
+        self.running = False
+        if self.handle:
+            self.handle.cancel()
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_result(None)
+        if self.room and not self.room.done():
+            self.room.set_result(None)
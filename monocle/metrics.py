@@ -0,0 +1,143 @@
+from bisect import bisect_left
+from threading import Lock
+
+from aiopogo import HashServer
+
+from .shared import LOOP, get_logger
+
+REGISTRY = []
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(n, v) for n, v in zip(names, values)) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=(), callback=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.callback = callback
+        # {(label values): value}
+        self.values = {} if labels else {(): 0}
+        # the DB writer lanes update metrics from their own threads
+        self.lock = Lock()
+        REGISTRY.append(self)
+
+    def samples(self):
+        if self.callback:
+            try:
+                yield self.name, (), self.callback()
+            except Exception:
+                pass
+            return
+        for values, value in tuple(self.values.items()):
+            yield self.name, values, value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, values, value in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(self.labels, values), value))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            try:
+                self.values[labels] += amount
+            except KeyError:
+                self.values[labels] = amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+        # one extra count for values above the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        total = 0
+        bucket = self.name + '_bucket'
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bucket, (bound,), total
+        yield bucket, ('+Inf',), self.count
+        yield self.name + '_sum', (), self.sum
+        yield self.name + '_count', (), self.count
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, values, value in self.samples():
+            labels = format_labels(('le',), values) if values else ''
+            lines.append('{}{} {}'.format(name, labels, value))
+        return '\n'.join(lines)
+
+
+def render():
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+async def serve(host, port):
+    """Serve the metrics in the Prometheus text format at /metrics"""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=render(), content_type='text/plain')
+
+    app = web.Application(loop=LOOP)
+    app.router.add_get('/metrics', handle_metrics)
+    handler = app.make_handler(access_log=None)
+    server = await LOOP.create_server(handler, host, port)
+    get_logger('metrics').info('Serving metrics on {}:{}', host, port)
+    return server
+
+
+VISITS = Counter('monocle_visits_total', 'Completed visits.')
+POKEMON_SEEN = Counter('monocle_pokemon_seen_total', 'Pokemon seen on visits.')
+CAPTCHAS = Counter('monocle_captchas_total', 'CAPTCHAs encountered.')
+SKIPS = Counter('monocle_skips_total', 'Spawns that were not visited.', ('reason',))
+WORKER_WAITS = Counter('monocle_worker_waits_total', 'Points that had to wait for a worker to come in range.')
+DB_ITEMS = Counter('monocle_db_items_total', 'Items processed by the DB processor.', ('type',))
+
+LATENESS = Histogram('monocle_visit_lateness_seconds', 'Seconds between a spawn and its visit.',
+                     (5, 10, 20, 30, 45, 60, 90, 120, 180, 300))
+SPEEDS = Histogram('monocle_visit_speed', 'Travel speed of workers to their visits, in SPEED_UNIT per hour.',
+                   (0.1, 1, 2.5, 5, 7.5, 10, 12.5, 15, 17.5, 20, 25))
+VISIT_SECONDS = Histogram('monocle_visit_duration_seconds', 'Time taken by each visit.',
+                          (0.25, 0.5, 1, 2, 3, 5, 10, 20, 30))
+DB_TRANSACTION_ROWS = Histogram('monocle_db_transaction_items', 'Items written in each DB transaction.',
+                                (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+DB_TRANSACTION_SECONDS = Histogram('monocle_db_transaction_seconds', 'Seconds between the first write of each DB transaction and its commit.',
+                                   (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+DB_QUEUE = Gauge('monocle_db_queue', 'Items waiting to be processed by the DB processor.')
+HASHES_REMAINING = Gauge('monocle_hashes_remaining', 'Hashes remaining in the current period.',
+                         callback=lambda: HashServer.status['remaining'])
+HASHES_MAXIMUM = Gauge('monocle_hashes_maximum', 'Hashes allowed per period.',
+                       callback=lambda: HashServer.status['maximum'])
@@ -1,10 +1,10 @@
-from asyncio import gather, Semaphore, sleep, Task, CancelledError
+from asyncio import gather, wait_for, Semaphore, sleep, Task, CancelledError, TimeoutError
 from datetime import datetime
 from statistics import median
 from sys import platform
 from cyrandom import shuffle
 from collections import deque
-from itertools import dropwhile
+from operator import itemgetter
 from time import time, monotonic
 
 from aiopogo import HashServer
@@ -13,8 +13,12 @@ from sqlalchemy.exc import OperationalError
 from .db import SIGHTING_CACHE, MYSTERY_CACHE
 from .utils import get_current_hour, dump_pickle, get_start_coords, get_bootstrap_points, randomize_point, best_factors, percentage_split
 from .shared import get_logger, LOOP, run_threaded, ACCOUNTS
+from .schedule import SpawnSchedule
+from .planner import Planner
+from .job_queue import JobQueue
+from .metrics import SKIPS, WORKER_WAITS
 from . import bounds, db_proc, spawns, sanitized as conf
-from .worker import Worker
+from .worker import Worker, UNIT
 
 ANSI = '\x1b[2J\x1b[H'
 if platform == 'win32':
@@ -69,10 +73,13 @@ class Overseer:
         self.running = True
         self.all_seen = False
         self.idle_seconds = 0
+        self.schedule = SpawnSchedule()
+        self.planner = Planner(UNIT, Worker.scan_delay) if conf.PLAN_AHEAD else None
+        self.jobs = JobQueue(Worker.index, self.expire_job) if conf.PULL_WORKERS else None
         self.log.info('Overseer initialized')
         self.pokemon_found = ''
 
-    def start(self, status_bar):
+    def start(self, status_bar, worker_numbers=None):
         self.captcha_queue = self.manager.captcha_queue()
         Worker.captcha_queue = self.manager.captcha_queue()
         self.extra_queue = self.manager.extra_queue()
@@ -80,16 +87,15 @@ class Overseer:
         if conf.MAP_WORKERS:
             Worker.worker_dict = self.manager.worker_dict()
 
-        for username, account in ACCOUNTS.items():
-            account['username'] = username
-            if account.get('banned'):
-                continue
-            if account.get('captcha'):
-                self.captcha_queue.put(account)
-            else:
-                self.extra_queue.put(account)
-
-        self.workers = tuple(Worker(worker_no=x) for x in range(conf.GRID[0] * conf.GRID[1]))
+        # shards run a range of the workers, with accounts queued by the supervisor
+        if worker_numbers is None:
+            self.queue_accounts(self.captcha_queue, self.extra_queue)
+            worker_numbers = range(conf.GRID[0] * conf.GRID[1])
+        else:
+            # spread the shard's workers over its own region
+            Worker.first_number = worker_numbers.start
+            Worker.start_grid = best_factors(len(worker_numbers))
+        self.workers = tuple(Worker(worker_no=x) for x in worker_numbers)
         db_proc.start()
         LOOP.call_later(10, self.update_count)
         LOOP.call_later(max(conf.SWAP_OLDEST, conf.MINIMUM_RUNTIME), self.swap_oldest)
@@ -97,6 +103,17 @@ class Overseer:
         if status_bar:
             LOOP.call_soon(self.print_status)
 
+    @staticmethod
+    def queue_accounts(captcha_queue, extra_queue):
+        for username, account in ACCOUNTS.items():
+            account['username'] = username
+            if account.get('banned'):
+                continue
+            if account.get('captcha'):
+                captcha_queue.put(account)
+            else:
+                extra_queue.put(account)
+
     def update_count(self):
         self.things_count.append(str(db_proc.count))
         self.pokemon_found = (
@@ -139,7 +156,7 @@ class Overseer:
             except Exception as e:
                 self.log.exception('A wild {} appeared in exit_progress!', e.__class__.__name__)
 
-    def update_stats(self, refresh=conf.STAT_REFRESH, med=median, count=conf.GRID[0] * conf.GRID[1]):
+    def update_stats(self, refresh=conf.STAT_REFRESH, med=median):
         visits = []
         seen_per_worker = []
         after_spawns = []
@@ -175,7 +192,7 @@ class Overseer:
             'sightings cache: {}, mystery cache: {}, DB queue: {}\n'
         ).format(
             len(spawns), len(spawns.unknown), spawns.cells_count,
-            count, self.coroutines_count,
+            len(self.workers), self.coroutines_count,
             len(SIGHTING_CACHE), len(MYSTERY_CACHE), len(db_proc)
         )
         LOOP.call_later(refresh, self.update_stats)
@@ -224,6 +241,10 @@ class Overseer:
         return dots, messages
 
     def update_coroutines_count(self, simple=True, loop=LOOP):
+        if self.jobs and simple:
+            # busy worker loops, without scanning every task
+            self.coroutines_count = len(self.workers) - len(self.jobs.waiting)
+            return
         try:
             tasks = Task.all_tasks(loop)
             self.coroutines_count = len(tasks) if simple else sum(not t.done() for t in tasks)
@@ -311,20 +332,6 @@ class Overseer:
         minutes = ((time() * 1000) - earliest) / 60000
         return worker, minutes
 
-    def get_start_point(self):
-        smallest_diff = float('inf')
-        now = time() % 3600
-        closest = None
-
-        for spawn_id, spawn_time in spawns.known.values():
-            time_diff = now - spawn_time
-            if 0 < time_diff < smallest_diff:
-                smallest_diff = time_diff
-                closest = spawn_id
-            if smallest_diff < 3:
-                break
-        return closest
-
     async def update_spawns(self, initial=False):
         while True:
             try:
@@ -345,7 +352,6 @@ class Overseer:
 
     async def launch(self, bootstrap, pickle):
         exceptions = 0
-        self.next_mystery_reload = 0
 
         if not pickle or not spawns.unpickle():
             await self.update_spawns(initial=True)
@@ -358,7 +364,10 @@ class Overseer:
                 return
 
         update_spawns = False
-        self.mysteries = spawns.mystery_gen()
+        self.schedule.load()
+        if self.jobs:
+            for worker in self.workers:
+                LOOP.create_task(self.pull_visits(worker))
         while True:
             try:
                 await self._launch(update_spawns)
@@ -378,22 +387,13 @@ class Overseer:
         if update_spawns:
             await self.update_spawns()
             LOOP.create_task(run_threaded(dump_pickle, 'accounts', ACCOUNTS))
-            spawns_iter = iter(spawns.items())
-        else:
-            start_point = self.get_start_point()
-            if start_point and not spawns.after_last():
-                spawns_iter = dropwhile(
-                    lambda s: s[1][0] != start_point, spawns.items())
-            else:
-                spawns_iter = iter(spawns.items())
-
-        current_hour = get_current_hour()
-        if spawns.after_last():
-            current_hour += 3600
 
+        # reload spawns and save accounts every hour
+        reload_time = get_current_hour() + 3600
         captcha_limit = conf.MAX_CAPTCHAS
-        skip_spawn = conf.SKIP_SPAWN
-        for point, (spawn_id, spawn_seconds) in spawns_iter:
+        plan_ahead = conf.PLAN_AHEAD
+        schedule = self.schedule
+        while True:
             try:
                 if self.captcha_queue.qsize() > captcha_limit:
                     self.paused = True
@@ -402,36 +402,91 @@ class Overseer:
             except (EOFError, BrokenPipeError, FileNotFoundError):
                 pass
 
-            spawn_time = spawn_seconds + current_hour
-
             # negative = hasn't happened yet
             # positive = already happened
+            spawn_time = schedule.peek() or float('inf')
             time_diff = time() - spawn_time
 
             while time_diff < 0.5:
-                try:
-                    mystery_point = next(self.mysteries)
-
-                    await self.coroutine_semaphore.acquire()
-                    LOOP.create_task(self.try_point(mystery_point))
-                except StopIteration:
-                    if self.next_mystery_reload < monotonic():
-                        self.mysteries = spawns.mystery_gen()
-                        self.next_mystery_reload = monotonic() + conf.RESCAN_UNKNOWN
-                    else:
-                        await sleep(min(spawn_time - time() + .5, self.next_mystery_reload - monotonic()), loop=LOOP)
+                if time() > reload_time:
+                    return
+                mystery_point = spawns.pop_mystery()
+                if mystery_point:
+                    await self.dispatch(mystery_point)
+                else:
+                    # wake up at least every RESCAN_UNKNOWN for new points
+                    next_mystery = spawns.next_mystery_time() or float('inf')
+                    await sleep(min(spawn_time - time() + .5,
+                                    next_mystery - time(),
+                                    conf.RESCAN_UNKNOWN,
+                                    reload_time - time() + .5), loop=LOOP)
+                spawn_time = schedule.peek() or float('inf')
                 time_diff = time() - spawn_time
 
-            if time_diff > 5 and spawn_id in SIGHTING_CACHE.store:
-                self.redundant += 1
+            spawn_time, spawn_id, point = schedule.pop()
+            if self.skip(spawn_time, spawn_id):
                 continue
-            elif time_diff > skip_spawn:
-                self.skipped += 1
+
+            if self.planner:
+                visits = [(spawn_time, spawn_id, point)]
+                horizon = time() + plan_ahead
+                while len(visits) < self.planner.visits:
+                    next_time = schedule.peek()
+                    if next_time is None or next_time > horizon:
+                        break
+                    visit = schedule.pop()
+                    if not self.skip(visit[0], visit[1]):
+                        visits.append(visit)
+                # planning runs in a thread while spawns keep being dispatched
+                LOOP.create_task(self.dispatch_plan(visits))
                 continue
 
+            await self.dispatch(point, spawn_time, spawn_id)
+
+    def skip(self, spawn_time, spawn_id, skip_spawn=conf.SKIP_SPAWN):
+        """Returns True, and counts it, if a spawn needs no visit any more"""
+        time_diff = time() - spawn_time
+        covered = spawn_id if isinstance(spawn_id, tuple) else (spawn_id,)
+        if time_diff > 5 and all(x in SIGHTING_CACHE.store for x in covered):
+            self.redundant += 1
+            SKIPS.inc('redundant')
+            return True
+        elif time_diff > skip_spawn:
+            self.skipped += 1
+            SKIPS.inc('skipped')
+            return True
+        return False
+
+    async def dispatch(self, point, spawn_time=None, spawn_id=None):
+        if self.jobs:
+            await self.jobs.post(randomize_point(point), spawn_time, spawn_id)
+        else:
             await self.coroutine_semaphore.acquire()
             LOOP.create_task(self.try_point(point, spawn_time, spawn_id))
 
+    async def pull_visits(self, worker):
+        """Visit the points that a worker pulls from the job queue"""
+        while self.running:
+            job = await self.jobs.take(worker)
+            if job is None:
+                return
+            _, _, point, spawn_time, spawn_id, _ = job
+            try:
+                async with worker.busy:
+                    if spawn_time:
+                        worker.after_spawn = time() - spawn_time
+                    if await worker.visit(point, spawn_id):
+                        self.visits += 1
+            except CancelledError:
+                raise
+            except Exception:
+                self.log.exception('An exception occurred in pull_visits')
+
+    def expire_job(self, job):
+        if job[3]:
+            self.skipped += 1
+            SKIPS.inc('skipped')
+
     async def try_again(self, point):
         async with self.coroutine_semaphore:
             worker = await self.best_worker(point, False)
@@ -482,7 +537,8 @@ class Overseer:
                 tasks.extend(visit_release(w, n, grid, bounds.polygons[i])
                              for n, w in enumerate(workers))
         else:
-            tasks = (visit_release(w, n) for n, w in enumerate(self.workers))
+            tasks = (visit_release(w, n, Worker.start_grid)
+                     for n, w in enumerate(self.workers))
         await gather(*tasks, loop=LOOP)
 
     async def bootstrap_two(self):
@@ -507,6 +563,7 @@ class Overseer:
             if not worker:
                 if spawn_time:
                     self.skipped += 1
+                    SKIPS.inc('skipped')
                 return
             async with worker.busy:
                 if spawn_time:
@@ -521,28 +578,86 @@ class Overseer:
         finally:
             self.coroutine_semaphore.release()
 
+    async def dispatch_plan(self, visits):
+        """Assign upcoming spawns to idle workers together
+
+        Spawns that no worker could be planned for are left to dispatch,
+        each once it has spawned.
+        """
+        workers = [(worker, worker.location, last_request)
+                   for worker, (_, last_request) in Worker.index.idle.items()]
+        try:
+            itineraries, unassigned = await run_threaded(
+                self.planner.plan, workers, visits)
+        except Exception:
+            self.log.exception('An exception occurred while planning visits')
+            itineraries, unassigned = {}, visits
+        for worker, itinerary in itineraries.items():
+            if worker.busy.locked():
+                # taken by another visit while planning
+                unassigned.extend(itinerary)
+                continue
+            await worker.busy.acquire()
+            await self.coroutine_semaphore.acquire()
+            LOOP.create_task(self.follow_plan(worker, itinerary))
+        # visits are popped up to PLAN_AHEAD seconds early
+        unassigned.sort(key=itemgetter(0))
+        for spawn_time, spawn_id, point in unassigned:
+            delay = spawn_time - time()
+            if delay > 0:
+                await sleep(delay, loop=LOOP)
+            if self.skip(spawn_time, spawn_id):
+                continue
+            await self.dispatch(point, spawn_time, spawn_id)
+
+    async def follow_plan(self, worker, itinerary):
+        """Visit planned spawns in order with a worker that is already busy"""
+        try:
+            for spawn_time, spawn_id, point in itinerary:
+                if not self.running:
+                    break
+                point = randomize_point(point)
+                arrival, _ = self.planner.arrival(
+                    worker.location, worker.last_request, spawn_time, point)
+                if arrival - spawn_time > conf.GIVE_UP_KNOWN:
+                    self.skipped += 1
+                    SKIPS.inc('skipped')
+                    continue
+                delay = arrival - time()
+                if delay > 0:
+                    await sleep(delay, loop=LOOP)
+                if self.skip(spawn_time, spawn_id):
+                    continue
+                worker.speed = worker.travel_speed(point)
+                worker.after_spawn = time() - spawn_time
+                if await worker.visit(point, spawn_id):
+                    self.visits += 1
+        except CancelledError:
+            raise
+        except Exception:
+            self.log.exception('An exception occurred in follow_plan')
+        finally:
+            worker.busy.release()
+            self.coroutine_semaphore.release()
+
     async def best_worker(self, point, skip_time):
-        good_enough = conf.GOOD_ENOUGH
+        index = Worker.index
         while self.running:
-            gen = (w for w in self.workers if not w.busy.locked())
-            try:
-                worker = next(gen)
-                lowest_speed = worker.travel_speed(point)
-            except StopIteration:
-                lowest_speed = float('inf')
-            for w in gen:
-                speed = w.travel_speed(point)
-                if speed < lowest_speed:
-                    lowest_speed = speed
-                    worker = w
-                    if speed < good_enough:
-                        break
-            if lowest_speed < conf.SPEED_LIMIT:
-                worker.speed = lowest_speed
+            worker, speed = index.best(point)
+            if worker:
+                worker.speed = speed
                 return worker
-            if skip_time and monotonic() > skip_time:
+            if skip_time:
+                timeout = skip_time - monotonic()
+                if timeout <= 0:
+                    return None
+            else:
+                timeout = None
+            WORKER_WAITS.inc()
+            try:
+                await wait_for(index.wait(point), timeout, loop=LOOP)
+            except TimeoutError:
                 return None
-            await sleep(conf.SEARCH_SLEEP, loop=LOOP)
 
     def refresh_dict(self):
         while not self.extra_queue.empty():
@@ -0,0 +1,164 @@
+from collections import defaultdict
+from heapq import nsmallest
+
+from . import sanitized as conf
+from .utils import get_distance
+
+INFINITY = float('inf')
+
+
+def min_cost_assignment(costs, columns):
+    """Hungarian algorithm for a rectangular cost matrix
+
+    costs is a list of rows of length columns, with no more rows than
+    columns. Returns the assigned column for each row.
+    """
+    rows = len(costs)
+    u = [0.0] * (rows + 1)
+    v = [0.0] * (columns + 1)
+    # row assigned to each column, 1-indexed with 0 meaning unassigned
+    p = [0] * (columns + 1)
+    way = [0] * (columns + 1)
+    for i in range(1, rows + 1):
+        p[0] = i
+        j0 = 0
+        minv = [INFINITY] * (columns + 1)
+        used = [False] * (columns + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            row = costs[i0 - 1]
+            ui0 = u[i0]
+            delta = INFINITY
+            j1 = 0
+            for j in range(1, columns + 1):
+                if not used[j]:
+                    current = row[j - 1] - ui0 - v[j]
+                    if current < minv[j]:
+                        minv[j] = current
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(columns + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    assignment = [None] * rows
+    for j in range(1, columns + 1):
+        if p[j]:
+            assignment[p[j] - 1] = j - 1
+    return assignment
+
+
+class Planner:
+    """Plans visits to upcoming spawns for a set of idle workers
+
+    Each round solves a min-cost assignment of the remaining visits to
+    workers, where the cost is how late a worker would arrive while staying
+    under the speed limit, then moves the matched workers to their visits
+    so the next round can chain another visit onto their itineraries.
+
+    The solver is pure Python and cubic, so only the first visits spawns
+    are planned at once and each visit only considers its candidates
+    cheapest workers.
+    """
+    # pairs that would cost more than this are never assigned
+    UNREACHABLE = 1e9
+
+    def __init__(self, unit, scan_delay, limit=conf.SPEED_LIMIT,
+                 give_up=conf.GIVE_UP_KNOWN, rounds=3, visits=40, candidates=5):
+        self.unit = unit
+        self.scan_delay = scan_delay
+        self.limit = limit
+        self.give_up = give_up
+        self.rounds = rounds
+        self.visits = visits
+        self.candidates = candidates
+
+    def arrival(self, location, last_request, spawn_time, point):
+        """Returns the earliest time a worker could visit point after it spawns"""
+        seconds = get_distance(location, point, self.unit) * 3600 / self.limit
+        return max(spawn_time, last_request + max(seconds, self.scan_delay)), seconds
+
+    def plan(self, workers, visits):
+        """Returns ({worker: [(spawn_time, spawn_id, point)]}, [unassigned])
+
+        Itineraries are in the order they should be visited. workers is a
+        sequence of (worker, location, last_request) and visits a sequence
+        of (spawn_time, spawn_id, point). Visits beyond the first self.visits
+        are returned unassigned.
+        """
+        state = {worker: (location, last_request)
+                 for worker, location, last_request in workers}
+        itineraries = defaultdict(list)
+        pending = list(visits[:self.visits])
+        for _ in range(self.rounds):
+            if not pending or not state:
+                break
+            candidates = list(state.items())
+            costs = []
+            arrivals = []
+            for spawn_time, _, point in pending:
+                row = []
+                times = []
+                for _, (location, last_request) in candidates:
+                    arrival, seconds = self.arrival(location, last_request, spawn_time, point)
+                    late = arrival - spawn_time
+                    if late > self.give_up:
+                        row.append(self.UNREACHABLE)
+                    else:
+                        # favor nearby workers when they would be equally late
+                        row.append(late + seconds * 0.1)
+                    times.append(arrival)
+                # leave out all but the cheapest workers for this visit
+                if len(row) > self.candidates:
+                    cutoff = nsmallest(self.candidates, row)[-1]
+                    row = [cost if cost <= cutoff else self.UNREACHABLE
+                           for cost in row]
+                costs.append(row)
+                arrivals.append(times)
+
+            # only workers that can reach at least one visit take part
+            useful = [j for j in range(len(candidates))
+                      if any(row[j] < self.UNREACHABLE for row in costs)]
+            if not useful:
+                break
+            candidates = [candidates[j] for j in useful]
+            costs = [[row[j] for j in useful] for row in costs]
+            arrivals = [[times[j] for j in useful] for times in arrivals]
+
+            matches = self.match(costs, len(candidates))
+            if not matches:
+                break
+            assigned = set()
+            for visit_index, column in matches:
+                worker = candidates[column][0]
+                visit = pending[visit_index]
+                itineraries[worker].append(visit)
+                state[worker] = visit[2], arrivals[visit_index][column]
+                assigned.add(visit_index)
+            pending = [v for i, v in enumerate(pending) if i not in assigned]
+        pending.extend(visits[self.visits:])
+        return itineraries, pending
+
+    def match(self, costs, columns):
+        """Returns [(row, column)] pairs of a min-cost assignment"""
+        if len(costs) <= columns:
+            assignment = min_cost_assignment(costs, columns)
+            pairs = ((i, j) for i, j in enumerate(assignment) if j is not None)
+        else:
+            transposed = [list(column) for column in zip(*costs)]
+            assignment = min_cost_assignment(transposed, len(costs))
+            pairs = ((i, j) for j, i in enumerate(assignment) if i is not None)
+        return [(i, j) for i, j in pairs if costs[i][j] < self.UNREACHABLE]
@@ -20,6 +20,8 @@ worker_count = config.GRID[0] * config.GRID[1]
 _valid_types = {
     'ACCOUNTS': set_sequence,
     'ACCOUNTS_CSV': path,
+    'ALT_DEM_DIRECTORY': str,
+    'ALT_INTERPOLATE': bool,
     'ALT_PRECISION': int,
     'ALT_RANGE': sequence,
     'ALWAYS_NOTIFY': int,
@@ -30,12 +32,23 @@ _valid_types = {
     'BOOTSTRAP_RADIUS': Number,
     'BOUNDARIES': object,
     'CACHE_CELLS': bool,
+    'CACHE_CELLS_SIZE': int,
     'CAPTCHAS_ALLOWED': int,
     'CAPTCHA_KEY': str,
+    'COALESCE_RADIUS': Number,
+    'COALESCE_WINDOW': Number,
     'COMPLETE_TUTORIAL': bool,
     'COROUTINES_LIMIT': int,
     'DB': dict,
+    'DB_ASYNC': bool,
+    'DB_BATCH_SIZE': int,
+    'DB_BATCH_WAIT': Number,
+    'DB_COMMIT_LATENCY': Number,
+    'DB_COMMIT_ROWS': int,
     'DB_ENGINE': str,
+    'DB_LANES': bool,
+    'DB_SPOOL': bool,
+    'DB_SPOOL_SEGMENT': int,
     'DIRECTORY': path,
     'DISCORD_INVITE_ID': str,
     'ENCOUNTER': str,
@@ -77,6 +90,8 @@ _valid_types = {
     'MAP_WORKERS': bool,
     'MAX_CAPTCHAS': int,
     'MAX_RETRIES': int,
+    'METRICS_HOST': str,
+    'METRICS_PORT': int,
     'MINIMUM_RUNTIME': Number,
     'MINIMUM_SCORE': Number,
     'MORE_POINTS': bool,
@@ -89,9 +104,11 @@ _valid_types = {
     'PASS': str,
     'PB_API_KEY': str,
     'PB_CHANNEL': int,
+    'PLAN_AHEAD': Number,
     'PLAYER_LOCALE': dict,
     'PROVIDER': str,
     'PROXIES': set_sequence,
+    'PULL_WORKERS': bool,
     'RARE_IDS': set_sequence_range,
     'RARITY_OVERRIDE': dict,
     'REFRESH_RATE': Number,
@@ -100,6 +117,7 @@ _valid_types = {
     'RESCAN_UNKNOWN': Number,
     'SCAN_DELAY': Number,
     'SEARCH_SLEEP': Number,
+    'SHARDS': int,
     'SHOW_TIMER': bool,
     'SIMULTANEOUS_LOGINS': int,
     'SIMULTANEOUS_SIMULATION': int,
@@ -110,6 +128,7 @@ _valid_types = {
     'SPEED_UNIT': str,
     'SPIN_COOLDOWN': Number,
     'SPIN_POKESTOPS': bool,
+    'SQLITE_WAL': bool,
     'STAT_REFRESH': Number,
     'STAY_WITHIN_MAP': bool,
     'SWAP_OLDEST': Number,
@@ -132,6 +151,8 @@ _valid_types = {
 _defaults = {
     'ACCOUNTS': None,
     'ACCOUNTS_CSV': None,
+    'ALT_DEM_DIRECTORY': None,
+    'ALT_INTERPOLATE': False,
     'ALT_PRECISION': 2,
     'ALT_RANGE': (300, 400),
     'ALWAYS_NOTIFY': 0,
@@ -142,11 +163,22 @@ _defaults = {
     'BOOTSTRAP_RADIUS': 120,
     'BOUNDARIES': None,
     'CACHE_CELLS': False,
+    'CACHE_CELLS_SIZE': 100000,
     'CAPTCHAS_ALLOWED': 3,
     'CAPTCHA_KEY': None,
+    'COALESCE_RADIUS': 0,
+    'COALESCE_WINDOW': 30,
     'COMPLETE_TUTORIAL': False,
     'CONTROL_SOCKS': None,
     'COROUTINES_LIMIT': worker_count,
+    'DB_ASYNC': False,
+    'DB_BATCH_SIZE': 1,
+    'DB_BATCH_WAIT': 0.5,
+    'DB_COMMIT_LATENCY': 5,
+    'DB_COMMIT_ROWS': 1000,
+    'DB_LANES': False,
+    'DB_SPOOL': False,
+    'DB_SPOOL_SEGMENT': 4194304,
     'DIRECTORY': '.',
     'DISCORD_INVITE_ID': None,
     'ENCOUNTER': None,
@@ -183,6 +215,8 @@ _defaults = {
     'MAP_WORKERS': True,
     'MAX_CAPTCHAS': 0,
     'MAX_RETRIES': 3,
+    'METRICS_HOST': '127.0.0.1',
+    'METRICS_PORT': None,
     'MINIMUM_RUNTIME': 10,
     'MORE_POINTS': False,
     'MOVE_FONT': 'sans-serif',
@@ -194,9 +228,11 @@ _defaults = {
     'PASS': None,
     'PB_API_KEY': None,
     'PB_CHANNEL': None,
+    'PLAN_AHEAD': 0,
     'PLAYER_LOCALE': {'country': 'US', 'language': 'en', 'timezone': 'America/Denver'},
     'PROVIDER': None,
     'PROXIES': None,
+    'PULL_WORKERS': False,
     'RARE_IDS': (),
     'RARITY_OVERRIDE': {},
     'REFRESH_RATE': 0.6,
@@ -204,7 +240,7 @@ _defaults = {
     'REPORT_SINCE': None,
     'RESCAN_UNKNOWN': 90,
     'SCAN_DELAY': 10,
-    'SEARCH_SLEEP': 2.5,
+    'SHARDS': 1,
     'SHOW_TIMER': False,
     'SIMULTANEOUS_LOGINS': 2,
     'SIMULTANEOUS_SIMULATION': 4,
@@ -215,6 +251,7 @@ _defaults = {
     'SPEED_UNIT': 'miles',
     'SPIN_COOLDOWN': 300,
     'SPIN_POKESTOPS': True,
+    'SQLITE_WAL': False,
     'STAT_REFRESH': 5,
     'STAY_WITHIN_MAP': True,
     'SWAP_OLDEST': 21600 / worker_count,
@@ -0,0 +1,73 @@
+from time import time
+
+from . import spawns, sanitized as conf
+from .utils import get_current_hour
+
+
+class SpawnSchedule:
+    """Hour-cyclic cursor over the known spawns
+
+    spawns.order is kept sorted by spawn second, so finding the next spawn
+    from any point in the hour is a bisect and spawns added, changed or
+    removed by the DB processor are seen as soon as the cursor reaches them.
+    Spawns in a cluster are passed over until the last one of them.
+    """
+    def __init__(self):
+        self.hour = get_current_hour()
+        # entry of spawns.order that was last dispatched
+        self.cursor = (-1,)
+
+    def load(self, skip=conf.SKIP_SPAWN):
+        """Resume from the earliest spawn that can still be visited
+
+        Spawns that happened less than SKIP_SPAWN seconds ago are dispatched
+        late rather than lost to a restart.
+        """
+        now = time()
+        self.hour = get_current_hour(now)
+        seconds = now - self.hour - skip
+        if seconds < 0:
+            self.hour -= 3600
+            seconds += 3600
+        self.cursor = (seconds,)
+
+    def next(self):
+        while True:
+            entry = spawns.after(self.cursor)
+            if entry is None:
+                try:
+                    entry = spawns.order[0]
+                except IndexError:
+                    return None
+                self.hour += 3600
+                self.cursor = (-1,)
+            cluster = spawns.get_cluster(entry)
+            if cluster is None or cluster[1] == entry:
+                return entry
+            # covered by the visit for the last spawn of its cluster
+            self.cursor = entry
+
+    def peek(self):
+        """Returns the time of the next spawn, or None if there are none"""
+        entry = self.next()
+        if entry is None:
+            return None
+        return self.hour + entry[0]
+
+    def pop(self):
+        """Returns (spawn_time, spawn_id, point) of the next spawn
+
+        For a cluster of spawns, spawn_id is a tuple of every spawn_id the
+        visit covers and point is where to visit them from.
+        """
+        entry = self.next()
+        if entry is None:
+            return None
+        self.cursor = entry
+        seconds, point, spawn_id = entry
+        cluster = spawns.get_cluster(entry)
+        if cluster:
+            point, _, members = cluster
+            spawn_id = tuple(m[2] for m in members
+                             if spawns.known.get(m[1]) == (m[2], m[0]))
+        return self.hour + seconds, spawn_id, point
@@ -0,0 +1,52 @@
+from logging import getLevelName
+from os import environ
+from subprocess import Popen
+from sys import argv, executable
+
+from . import bounds, sanitized as conf
+from .utils import best_factors, percentage_split
+
+
+def get_regions(count=conf.SHARDS):
+    """Splits the boundaries into a grid of count rectangles
+
+    Returns [(north, east, south, west)] for each region.
+    """
+    rows, columns = best_factors(count)
+    height = (bounds.north - bounds.south) / rows
+    width = (bounds.east - bounds.west) / columns
+    return [(bounds.north - height * row,
+             bounds.west + width * (column + 1),
+             bounds.north - height * (row + 1),
+             bounds.west + width * column)
+            for row in range(rows) for column in range(columns)]
+
+
+def split_workers(regions, points, total=conf.GRID[0] * conf.GRID[1]):
+    """Divides the worker numbers between regions by how many points each has"""
+    counts = [1] * len(regions)
+    for lat, lon in points:
+        for i, (north, east, south, west) in enumerate(regions):
+            if south <= lat <= north and west <= lon <= east:
+                counts[i] += 1
+                break
+    total_points = sum(counts)
+    percentages = [count / total_points for count in counts]
+    return list(percentage_split(range(total), percentages))
+
+
+def start_shard(region, workers, log_level=None, bootstrap=False, metrics_port=None):
+    """Starts a scanner process for a region with a range of worker numbers"""
+    env = environ.copy()
+    env['MONOCLE_SHARD'] = ','.join(repr(x) for x in region)
+    args = [executable, argv[0], '--no-status-bar',
+            '--workers', '{}:{}'.format(workers.start, workers.stop)]
+    if log_level is not None:
+        if isinstance(log_level, int):
+            log_level = getLevelName(log_level)
+        args.extend(('--log-level', log_level))
+    if bootstrap:
+        args.append('--bootstrap')
+    if metrics_port:
+        args.extend(('--metrics-port', str(metrics_port)))
+    return Popen(args, env=env)
@@ -1,13 +1,17 @@
 import sys
 
-from collections import deque, OrderedDict
-from time import time
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict, deque
+from heapq import heappop, heappush
 from itertools import chain
 from hashlib import sha256
+from math import ceil, cos, radians
+from threading import Lock
+from time import time
 
 from . import bounds, db, sanitized as conf
 from .shared import get_logger
-from .utils import dump_pickle, load_pickle, get_current_hour, time_until_time
+from .utils import dump_pickle, load_pickle, get_current_hour, time_until_time, get_distance
 
 
 class BaseSpawns:
@@ -15,15 +19,41 @@ class BaseSpawns:
     def __init__(self):
         ## Spawns with known times
         # {(lat, lon): (spawn_id, spawn_seconds)}
-        self.known = OrderedDict()
+        self.known = {}
         # {spawn_id: despawn_seconds}
         self.despawn_times = {}
+        # known spawns sorted by the second of the hour that they spawn
+        # [(spawn_seconds, (lat, lon), spawn_id)]
+        self.order = []
+        # the DB processor and spawn updates change order from other threads
+        self.order_lock = Lock()
+        # known spawns that can be covered by a single visit
+        # {(lat, lon): (visit_point, last_entry, (entry,))} with entries of order
+        self.clusters = {}
 
         ## Spawns with unknown times
         # {(lat, lon)}
         self.unknown = set()
 
-        self.class_version = 3
+        ## Scheduling of unknown points
+        # heap of [(due, -sightings, (lat, lon))], may hold stale entries
+        self.mysteries = []
+        # {(lat, lon): due} for the current entry of each point in mysteries
+        self.mystery_due = {}
+        # points added by other threads, to be pushed onto mysteries
+        self.new_mysteries = deque()
+        # {(lat, lon): [second of the hour it was visited or seen]}
+        self.observations = {}
+        # {(lat, lon): mystery sightings}
+        self.sightings = {}
+
+        ## Incremental updates from the database
+        # greatest spawnpoints.updated loaded so far
+        self.updated = None
+        # time of the last update that loaded every spawnpoint
+        self.reloaded = 0
+
+        self.class_version = 6
         self.db_hash = sha256(conf.DB_ENGINE.encode()).digest()
         self.log = get_logger('spawns')
 
@@ -33,7 +63,17 @@ class BaseSpawns:
     def __bool__(self):
         return len(self.despawn_times) > 0
 
-    def update(self):
+    def update(self, full_every=86400, overlap=600):
+        """Load spawnpoints from the database
+
+        Every full_every seconds all of them are loaded. Otherwise only
+        those updated since the greatest updated value already loaded, less
+        overlap seconds for rows that were committed late, are merged in.
+        Spawnpoints reset to unknown by another process and the clusters
+        of new spawns are only picked up by the full loads.
+        """
+        now = time()
+        full = self.updated is None or now - self.reloaded >= full_every
         bound = bool(bounds)
         last_migration = conf.LAST_MIGRATION
 
@@ -44,7 +84,11 @@ class BaseSpawns:
                                      db.Spawnpoint.lat <= bounds.north,
                                      db.Spawnpoint.lon >= bounds.west,
                                      db.Spawnpoint.lon <= bounds.east)
+            if not full:
+                query = query.filter(db.Spawnpoint.updated > self.updated - overlap)
             known = {}
+            updated = self.updated or 0
+            count = 0
             for spawn in query:
                 point = spawn.lat, spawn.lon
 
@@ -52,26 +96,246 @@ class BaseSpawns:
                 if bound and point not in bounds:
                     continue
 
-                if not spawn.updated or spawn.updated <= last_migration:
-                    self.unknown.add(point)
+                count += 1
+                db.SPAWNPOINT_CACHE.load(spawn)
+                if spawn.updated and spawn.updated > updated:
+                    updated = spawn.updated
+                if not full:
+                    self.merge(spawn, point, last_migration)
                     continue
 
-                if spawn.duration == 60:
-                    spawn_time = spawn.despawn_time
-                else:
-                    spawn_time = (spawn.despawn_time + 1800) % 3600
+                if not spawn.updated or spawn.updated <= last_migration:
+                    self.add_unknown(point)
+                    continue
 
                 self.despawn_times[spawn.spawn_id] = spawn.despawn_time
-                known[point] = spawn.spawn_id, spawn_time
-        self.known = OrderedDict(sorted(known.items(), key=lambda k: k[1][1]))
-
-    def after_last(self):
+                known[point] = spawn.spawn_id, self.spawn_seconds(
+                    spawn.despawn_time, spawn.duration)
+                self.observations.pop(point, None)
+                self.sightings.pop(point, None)
+
+        self.updated = updated
+        if not full:
+            self.log.info('Merged {} updated spawnpoints.', count)
+            return
+        self.reloaded = now
+        order = sorted((seconds, point, spawn_id)
+                       for point, (spawn_id, seconds) in known.items())
+        with self.order_lock:
+            self.known = known
+            self.order = order
+        self.clusters = self.cluster()
+
+    def merge(self, spawn, point, last_migration):
+        """Apply a spawnpoint loaded by an incremental update"""
+        if not spawn.updated or spawn.updated <= last_migration:
+            previous = self.known.get(point)
+            if previous and previous[0] == spawn.spawn_id:
+                self.remove_known(spawn.spawn_id, point)
+            elif point not in self.unknown:
+                self.add_unknown(point)
+            return
+        self.add_known(spawn.spawn_id, spawn.despawn_time, point, spawn.duration)
+
+    def cluster(self, radius=conf.COALESCE_RADIUS, window=conf.COALESCE_WINDOW):
+        """Group known spawns that can be covered by a single visit
+
+        Spawns within radius meters of a spawn and spawning within window
+        seconds after it are visited together from its point, when the last
+        of them spawns.
+        """
+        if not radius:
+            return {}
+        # cells about radius meters high, searched far enough to the sides
+        step = radius / 111320
+        columns = ceil(1 / cos(radians(max(abs(bounds.north), abs(bounds.south)))))
+        cells = defaultdict(list)
+        for entry in self.order:
+            lat, lon = entry[1]
+            cells[int(lat // step), int(lon // step)].append(entry)
+
+        clusters = {}
+        for entry in self.order:
+            seconds, point, _ = entry
+            if point in clusters:
+                continue
+            row, column = int(point[0] // step), int(point[1] // step)
+            members = [entry]
+            for r in range(row - 1, row + 2):
+                for c in range(column - columns, column + columns + 1):
+                    for other in cells.get((r, c), ()):
+                        if (other is not entry and other[1] not in clusters
+                                and (other[0] - seconds) % 3600 <= window
+                                and get_distance(point, other[1], 3) <= radius):
+                            members.append(other)
+            if len(members) > 1:
+                last = max(members, key=lambda m: (m[0] - seconds) % 3600)
+                cluster = point, last, tuple(members)
+                for member in members:
+                    clusters[member[1]] = cluster
+        return clusters
+
+    def get_cluster(self, entry):
+        """Returns the still valid cluster an entry of order belongs to, if any
+
+        Clusters are only rebuilt with full loads, so one is no longer valid
+        as soon as any of its members was changed or removed since.
+        """
         try:
-            k = next(reversed(self.known))
-            seconds = self.known[k][1]
-            return time() % 3600 > seconds
-        except (StopIteration, KeyError, TypeError):
-            return False
+            cluster = self.clusters[entry[1]]
+        except KeyError:
+            return None
+        known = self.known
+        for seconds, point, spawn_id in cluster[2]:
+            if known.get(point) != (spawn_id, seconds):
+                return None
+        return cluster
+
+    @staticmethod
+    def spawn_seconds(despawn_time, duration):
+        if duration == 60:
+            return despawn_time
+        return (despawn_time + 1800) % 3600
+
+    def add_known(self, spawn_id, despawn_time, point, duration=None):
+        self.despawn_times[spawn_id] = despawn_time
+        self.unknown.discard(point)
+        # only needed to schedule visits while the time was unknown
+        self.observations.pop(point, None)
+        self.sightings.pop(point, None)
+        if point in bounds:
+            self.set_known(point, (spawn_id, self.spawn_seconds(despawn_time, duration)))
+
+    def set_known(self, point, spawn):
+        with self.order_lock:
+            previous = self.known.get(point)
+            if previous == spawn:
+                return
+            if previous:
+                self.discard_order(point, previous)
+            self.known[point] = spawn
+            spawn_id, seconds = spawn
+            insort(self.order, (seconds, point, spawn_id))
+
+    def remove_known(self, spawn_id, point):
+        """Treat a spawn as unknown until its time is learned again"""
+        self.despawn_times.pop(spawn_id, None)
+        with self.order_lock:
+            previous = self.known.pop(point, None)
+            if previous:
+                self.discard_order(point, previous)
+        if point in bounds:
+            self.add_unknown(point)
+
+    def discard_order(self, point, spawn):
+        """Remove a spawn from order, with order_lock held"""
+        spawn_id, seconds = spawn
+        entry = seconds, point, spawn_id
+        order = self.order
+        i = bisect_left(order, entry)
+        if i < len(order) and order[i] == entry:
+            del order[i]
+
+    def after(self, key):
+        """Returns the first entry of order after key, None if there are none
+
+        A (spawn_seconds,) key will return the first spawn at or after
+        that second.
+        """
+        with self.order_lock:
+            order = self.order
+            try:
+                return order[bisect_right(order, key)]
+            except IndexError:
+                return None
+
+    def is_mystery(self, point):
+        return point in self.unknown
+
+    def add_mystery_sighting(self, point, seen):
+        self.sightings[point] = self.sightings.get(point, 0) + 1
+        self.observe(point, seen)
+
+    def observe(self, point, seen, keep=12):
+        """Record the second of the hour that a point was visited or seen"""
+        seconds = self.observations.setdefault(point, [])
+        seconds.append(int(seen) % 3600)
+        if len(seconds) > keep:
+            del seconds[0]
+
+    def mystery_due_time(self, point, now, rescan=conf.RESCAN_UNKNOWN):
+        """Returns when an unknown point should be visited next
+
+        Points that were never observed are due immediately. Otherwise the
+        visit is at least RESCAN_UNKNOWN away and at the first second of
+        the hour that is far enough from every second the point has been
+        observed at, so each visit covers a part of the hour that's still
+        unaccounted for. That spacing is a quarter of the largest gap
+        between observations, shrinking as the point gathers sightings.
+        """
+        observed = self.observations.get(point)
+        if not observed:
+            return now
+        seconds = sorted(set(observed))
+        gaps = [b - a for a, b in zip(seconds, seconds[1:])]
+        gaps.append(seconds[0] + 3600 - seconds[-1])
+        spacing = max(gaps) / 4 / (1 + min(self.sightings.get(point, 0), 3))
+
+        start = now + rescan
+        offset = candidate = start % 3600
+        for _ in range(2 * len(seconds) + 1):
+            for second in seconds:
+                distance = (candidate - second) % 3600
+                if min(distance, 3600 - distance) < spacing:
+                    # move past the observation and check again
+                    candidate += spacing - distance if distance < spacing else 3600 - distance + spacing
+                    break
+            else:
+                break
+        return start + candidate - offset
+
+    def push_mystery(self, point, due):
+        self.mystery_due[point] = due
+        heappush(self.mysteries, (due, -self.sightings.get(point, 0), point))
+
+    def peek_mystery(self):
+        """Returns the next (due, point) or None if there are no unknown points"""
+        new_mysteries = self.new_mysteries
+        if new_mysteries:
+            now = time()
+            while new_mysteries:
+                point = new_mysteries.popleft()
+                if point not in self.mystery_due:
+                    self.push_mystery(point, self.mystery_due_time(point, now))
+
+        mysteries = self.mysteries
+        while mysteries:
+            due, _, point = mysteries[0]
+            if self.mystery_due.get(point) == due:
+                if self.is_mystery(point):
+                    return due, point
+                del self.mystery_due[point]
+            heappop(mysteries)
+        return None
+
+    def pop_mystery(self):
+        """Returns the unknown point most due for a visit, or None if none are due
+
+        The point is rescheduled for its next visit right away.
+        """
+        entry = self.peek_mystery()
+        now = time()
+        if entry is None or entry[0] > now:
+            return None
+        point = entry[1]
+        heappop(self.mysteries)
+        self.observe(point, now)
+        self.push_mystery(point, self.mystery_due_time(point, now))
+        return point
+
+    def next_mystery_time(self):
+        entry = self.peek_mystery()
+        return entry[0] if entry else None
 
     def get_despawn_time(self, spawn_id, seen):
         hour = get_current_hour(now=seen)
@@ -91,6 +355,9 @@ class BaseSpawns:
                     state['bounds_hash'] == hash(bounds),
                     state['last_migration'] == conf.LAST_MIGRATION)):
                 self.__dict__.update(state)
+                self.mysteries = []
+                self.mystery_due = {}
+                self.new_mysteries = deque(self.unknown)
                 return True
             else:
                 self.log.warning('Configuration changed, reloading spawns from DB.')
@@ -103,6 +370,9 @@ class BaseSpawns:
     def pickle(self):
         state = self.__dict__.copy()
         del state['log']
+        del state['order_lock']
+        for key in ('mysteries', 'mystery_due', 'new_mysteries'):
+            del state[key]
         state.pop('cells_count', None)
         state['bounds_hash'] = hash(bounds)
         state['last_migration'] = conf.LAST_MIGRATION
@@ -118,15 +388,9 @@ class Spawns(BaseSpawns):
         super().__init__()
         self.cells_count = 0
 
-    def items(self):
-        return self.known.items()
-
-    def add_known(self, spawn_id, despawn_time, point):
-        self.despawn_times[spawn_id] = despawn_time
-        self.unknown.discard(point)
-
     def add_unknown(self, point):
         self.unknown.add(point)
+        self.new_mysteries.append(point)
 
     def unpickle(self):
         result = super().unpickle()
@@ -136,10 +400,6 @@ class Spawns(BaseSpawns):
             pass
         return result
 
-    def mystery_gen(self):
-        for mystery in self.unknown.copy():
-            yield mystery
-
 
 class MoreSpawns(BaseSpawns):
     def __init__(self):
@@ -150,28 +410,31 @@ class MoreSpawns(BaseSpawns):
         # {(lat, lon)}
         self.cell_points = set()
 
-    def items(self):
-        # return a copy since it may be modified
-        return self.known.copy().items()
-
-    def add_known(self, spawn_id, despawn_time, point):
-        self.despawn_times[spawn_id] = despawn_time
-        # add so that have_point() will be up to date
-        self.known[point] = None
-        self.unknown.discard(point)
+    def add_known(self, spawn_id, despawn_time, point, duration=None):
+        super().add_known(spawn_id, despawn_time, point, duration)
         self.cell_points.discard(point)
 
     def add_unknown(self, point):
         self.unknown.add(point)
         self.cell_points.discard(point)
+        self.new_mysteries.append(point)
+
+    def add_cell_point(self, point):
+        self.cell_points.add(point)
+        self.new_mysteries.append(point)
+
+    def unpickle(self):
+        result = super().unpickle()
+        if result:
+            self.new_mysteries.extend(self.cell_points)
+        return result
+
+    def is_mystery(self, point):
+        return point in self.unknown or point in self.cell_points
 
     def have_point(self, point):
         return point in chain(self.cell_points, self.known, self.unknown)
 
-    def mystery_gen(self):
-        for mystery in chain(self.unknown.copy(), self.cell_points.copy()):
-            yield mystery
-
     @property
     def cells_count(self):
         return len(self.cell_points)
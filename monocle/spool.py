@@ -0,0 +1,172 @@
+from os import listdir, makedirs, remove, replace
+from os.path import join
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+from queue import Empty
+from struct import Struct
+from threading import Condition
+
+from . import sanitized as conf
+from .shared import get_logger
+
+HEADER = Struct('<I')
+
+
+class Spool:
+    """A queue of DB items kept in append-only segment files
+
+    Items are read back from disk in order, so memory use doesn't grow with
+    the backlog. Reading position is made durable with ack() once the items
+    read so far have been committed; anything after it is read again when the
+    scanner restarts, or after rewind(). Segments that have been entirely
+    acknowledged are deleted. Every item is flushed to the OS as it's added,
+    so it survives the scanner crashing, though not the OS.
+    """
+    def __init__(self, folder=None, segment_size=conf.DB_SPOOL_SEGMENT):
+        self.folder = folder or join(conf.DIRECTORY, 'spool')
+        makedirs(self.folder, exist_ok=True)
+        self.segment_size = segment_size
+        self.log = get_logger('spool')
+        self.lock = Condition()
+        # items that can be read
+        self.count = 0
+        # items read since the last ack
+        self.unacked = 0
+        # items read since the spool was opened, to tell positions apart
+        self.read = 0
+        self.acked = self.load_ack()
+        self.recover()
+        self.reader = None
+        self.read_from(*self.acked)
+        self.writing = max(self.segments(), default=self.acked[0]) + 1
+        self.writer = open(self.path(self.writing), 'ab')
+        if self.count:
+            self.log.warning('Replaying {} spooled DB items.', self.count)
+
+    def __len__(self):
+        return self.count
+
+    def qsize(self):
+        return self.count
+
+    def empty(self):
+        return not self.count
+
+    def path(self, segment):
+        return join(self.folder, '{:010d}.seg'.format(segment))
+
+    def segments(self):
+        return sorted(int(name[:-4]) for name in listdir(self.folder)
+                      if name.endswith('.seg'))
+
+    def load_ack(self):
+        try:
+            with open(join(self.folder, 'ack'), 'r') as f:
+                segment, offset = f.read().split()
+            return int(segment), int(offset)
+        except (FileNotFoundError, ValueError):
+            return 0, 0
+
+    def recover(self):
+        """Count unacknowledged items and cut off any partly written one"""
+        segment, offset = self.acked
+        for number in self.segments():
+            if number < segment:
+                remove(self.path(number))
+                continue
+            position = offset if number == segment else 0
+            with open(self.path(number), 'r+b') as f:
+                f.seek(position)
+                while True:
+                    header = f.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+                    size, = HEADER.unpack(header)
+                    if len(f.read(size)) < size:
+                        break
+                    position = f.tell()
+                    self.count += 1
+                f.truncate(position)
+
+    def put(self, item):
+        data = dumps(item, HIGHEST_PROTOCOL)
+        with self.lock:
+            self.writer.write(HEADER.pack(len(data)))
+            self.writer.write(data)
+            self.writer.flush()
+            self.count += 1
+            if self.writer.tell() >= self.segment_size:
+                self.writer.close()
+                self.writing += 1
+                self.writer = open(self.path(self.writing), 'ab')
+            self.lock.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.lock:
+            if block and not self.lock.wait_for(lambda: self.count, timeout):
+                raise Empty
+            elif not self.count:
+                raise Empty
+            while True:
+                header = self.reader.read(HEADER.size)
+                if header:
+                    break
+                # the current segment is finished, move on to the next one
+                self.read_from(self.reading + 1, 0)
+            size, = HEADER.unpack(header)
+            self.count -= 1
+            self.unacked += 1
+            self.read += 1
+            return loads(self.reader.read(size))
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def read_from(self, segment, offset):
+        if self.reader:
+            self.reader.close()
+        self.reading = segment
+        try:
+            self.reader = open(self.path(segment), 'rb')
+        except FileNotFoundError:
+            # nothing was ever written to it
+            self.reader = open(self.path(segment), 'w+b')
+        self.reader.seek(offset)
+
+    def position(self):
+        """Where the next item will be read from, for ack()"""
+        with self.lock:
+            return self.reading, self.reader.tell(), self.read
+
+    def ack(self, position=None):
+        """Mark everything read before position as written to the database
+
+        Without a position, everything read so far is acknowledged.
+        """
+        with self.lock:
+            if position is None:
+                position = self.reading, self.reader.tell(), self.read
+            segment, offset, read = position
+            self.acked = segment, offset
+            self.unacked = self.read - read
+            location = join(self.folder, 'ack')
+            with open(location + '.tmp', 'w') as f:
+                f.write('{} {}'.format(*self.acked))
+            replace(location + '.tmp', location)
+            for number in self.segments():
+                if number >= segment:
+                    break
+                remove(self.path(number))
+
+    def rewind(self):
+        """Read everything since the last ack again"""
+        with self.lock:
+            self.read_from(*self.acked)
+            self.count += self.unacked
+            self.read -= self.unacked
+            self.unacked = 0
+            self.lock.notify()
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+            self.reader.close()
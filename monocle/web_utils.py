@@ -109,7 +109,7 @@ def sighting_to_marker(pokemon, names=POKEMON, moves=MOVES, damage=DAMAGE):
 
 
 def get_pokemarkers(after_id=0):
-    with session_scope() as session:
+    with session_scope(read_only=True) as session:
         pokemons = session.query(Sighting) \
             .filter(Sighting.expire_timestamp > time(),
                     Sighting.id > after_id)
@@ -119,7 +119,7 @@ def get_pokemarkers(after_id=0):
 
 
 def get_gym_markers(names=POKEMON):
-    with session_scope() as session:
+    with session_scope(read_only=True) as session:
         forts = get_forts(session)
     return [{
             'id': 'fort-' + str(fort['fort_id']),
@@ -134,7 +134,7 @@ def get_gym_markers(names=POKEMON):
 
 
 def get_spawnpoint_markers():
-    with session_scope() as session:
+    with session_scope(read_only=True) as session:
         spawns = session.query(Spawnpoint)
         return [{
             'spawn_id': spawn.spawn_id,
@@ -170,7 +170,7 @@ else:
 
 
 def get_pokestop_markers():
-    with session_scope() as session:
+    with session_scope(read_only=True) as session:
         pokestops = session.query(Pokestop)
         return [{
             'external_id': pokestop.external_id,
@@ -12,8 +12,10 @@ from cyrandom import choice, randint, uniform
 from pogeo import get_distance
 
 from .db import FORT_CACHE, MYSTERY_CACHE, SIGHTING_CACHE
-from .utils import round_coords, load_pickle, get_device_info, get_start_coords, Units, randomize_point
+from .metrics import CAPTCHAS, LATENESS, POKEMON_SEEN, SPEEDS, VISITS, VISIT_SECONDS
+from .utils import get_device_info, get_start_coords, Units, randomize_point
 from .shared import get_logger, LOOP, SessionManager, run_threaded, ACCOUNTS
+from .worker_index import WorkerIndex
 from . import altitudes, avatar, bounds, db_proc, spawns, sanitized as conf
 
 if conf.NOTIFY:
@@ -21,6 +23,7 @@ if conf.NOTIFY:
 
 if conf.CACHE_CELLS:
     from array import typecodes
+    from .cells import CellCache
     if 'Q' in typecodes:
         from pogeo import get_cell_ids_compact as _pogeo_cell_ids
     else:
@@ -50,19 +53,15 @@ class Worker:
     download_hash = ''
     scan_delay = conf.SCAN_DELAY if conf.SCAN_DELAY >= 10 else 10
     g = {'seen': 0, 'captchas': 0}
+    index = WorkerIndex(UNIT, scan_delay)
+    # grid that start points are spread over, and the worker number at its
+    # first square, which shards set for their region and range of workers
+    start_grid = conf.GRID
+    first_number = 0
 
     if conf.CACHE_CELLS:
-        cells = load_pickle('cells') or {}
-
-        @classmethod
-        def get_cell_ids(cls, point):
-            rounded = round_coords(point, 4)
-            try:
-                return cls.cells[rounded]
-            except KeyError:
-                cells = _pogeo_cell_ids(rounded)
-                cls.cells[rounded] = cells
-                return cells
+        cells = CellCache(_pogeo_cell_ids)
+        get_cell_ids = cells.get
     else:
         get_cell_ids = _pogeo_cell_ids
 
@@ -80,6 +79,10 @@ class Worker:
     if conf.NOTIFY:
         notifier = Notifier()
 
+    @classmethod
+    def start_coords(cls, worker_no):
+        return get_start_coords(worker_no - cls.first_number, cls.start_grid)
+
     def __init__(self, worker_no):
         self.worker_no = worker_no
         self.log = get_logger('worker-{}'.format(worker_no))
@@ -95,7 +98,7 @@ class Worker:
         try:
             self.location = self.account['location'][:2]
         except KeyError:
-            self.location = get_start_coords(worker_no)
+            self.location = self.start_coords(worker_no)
         self.altitude = None
         # last time of any request
         self.last_request = self.account.get('time', 0)
@@ -116,7 +119,7 @@ class Worker:
         self.unused_incubators = deque()
         self.initialize_api()
         # State variables
-        self.busy = Lock(loop=LOOP)
+        self.busy = BusyLock(self)
         # Other variables
         self.after_spawn = 0
         self.speed = 0
@@ -127,6 +130,7 @@ class Worker:
         self.pokestops = conf.SPIN_POKESTOPS
         self.next_spin = 0
         self.handle = HandleStub()
+        self.index.add(self)
 
     def initialize_api(self):
         device_info = get_device_info(self.account)
@@ -607,6 +611,7 @@ class Worker:
             challenge_url = responses['CHECK_CHALLENGE'].challenge_url
             if challenge_url != ' ':
                 self.g['captchas'] += 1
+                CAPTCHAS.inc()
                 if conf.CAPTCHA_KEY:
                     self.log.warning('{} has encountered a CAPTCHA, trying to solve', self.username)
                     await self.handle_captcha(challenge_url)
@@ -661,6 +666,7 @@ class Worker:
         except CaptchaException:
             self.error_code = 'CAPTCHA'
             self.g['captchas'] += 1
+            CAPTCHAS.inc()
             await sleep(1, loop=LOOP)
             await self.bench_account()
         except CaptchaSolveException:
@@ -771,7 +777,12 @@ class Worker:
         pokemon_seen = 0
         forts_seen = 0
         points_seen = 0
-        seen_target = not spawn_id
+        # a visit to a cluster of spawns targets all of them
+        if isinstance(spawn_id, tuple):
+            targets = spawn_id
+        else:
+            targets = (spawn_id,) if spawn_id else ()
+        seen_targets = set()
 
         if conf.ITEM_LIMITS and self.bag_items >= self.item_capacity:
             await self.clean_bag()
@@ -782,7 +793,8 @@ class Worker:
                 pokemon_seen += 1
 
                 normalized = self.normalize_pokemon(pokemon)
-                seen_target = seen_target or normalized['spawn_id'] == spawn_id
+                if normalized['spawn_id'] in targets:
+                    seen_targets.add(normalized['spawn_id'])
 
                 if (normalized not in SIGHTING_CACHE and
                         normalized not in MYSTERY_CACHE):
@@ -840,15 +852,15 @@ class Worker:
                         p = p.latitude, p.longitude
                         if spawns.have_point(p) or p not in bounds:
                             continue
-                        spawns.cell_points.add(p)
+                        spawns.add_cell_point(p)
                 except KeyError:
                     pass
 
-        if spawn_id:
+        for target in targets:
             db_proc.add({
                 'type': 'target',
-                'seen': seen_target,
-                'spawn_id': spawn_id})
+                'seen': target in seen_targets,
+                'spawn_id': target})
 
         if (conf.INCUBATE_EGGS and self.unused_incubators
                 and self.eggs and self.smart_throttle()):
@@ -870,6 +882,12 @@ class Worker:
                 reason = '{} empty visits'.format(self.empty_visits)
                 await self.swap_account(reason)
         self.visits += 1
+        VISITS.inc()
+        POKEMON_SEEN.inc(amount=pokemon_seen)
+        SPEEDS.observe(self.speed)
+        VISIT_SECONDS.observe(time() - start)
+        if spawn_id:
+            LATENESS.observe(self.after_spawn)
 
         if conf.MAP_WORKERS:
             self.worker_dict.update([(self.worker_no,
@@ -1188,7 +1206,7 @@ class Worker:
         try:
             self.location = self.account['location'][:2]
         except KeyError:
-            self.location = get_start_coords(self.worker_no)
+            self.location = self.start_coords(self.worker_no)
         self.inventory_timestamp = self.account.get('inventory_timestamp', 0) if self.items else 0
         self.player_level = self.account.get('level')
         self.last_request = self.account.get('time', 0)
@@ -1306,6 +1324,22 @@ class Worker:
             return False
 
 
+class BusyLock(Lock):
+    """Lock that keeps the idle worker index up to date"""
+    def __init__(self, worker):
+        super().__init__(loop=LOOP)
+        self.worker = worker
+
+    async def acquire(self):
+        await super().acquire()
+        self.worker.index.remove(self.worker)
+        return True
+
+    def release(self):
+        super().release()
+        self.worker.index.add(self.worker)
+
+
 class HandleStub:
     def cancel(self):
         pass
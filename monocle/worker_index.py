@@ -0,0 +1,273 @@
+from collections import defaultdict
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import time
+
+from . import bounds, sanitized as conf
+from .shared import LOOP
+from .utils import get_distance
+
+
+class Waiter:
+    """A point waiting for a worker that can reach it"""
+    __slots__ = ('point', 'limit', 'cell', 'number', 'future', 'when', 'handle')
+
+    def __init__(self, point, limit, cell, number):
+        self.point = point
+        self.limit = limit
+        self.cell = cell
+        # lower numbers have been waiting longer
+        self.number = number
+        self.future = LOOP.create_future()
+        self.when = None
+        self.handle = None
+
+
+class WorkerIndex:
+    """Bucket grid of idle worker locations
+
+    Workers are added when their busy lock is released and removed when it
+    is acquired, so only the cells surrounding a point need to be searched
+    to find the fastest idle worker. Points that no idle worker can reach yet
+    wait until a released worker can reach them, or until the time at which
+    the soonest idle worker will be able to. Waiting points are kept in the
+    same grid, and a released worker only wakes the one that has waited the
+    longest of those it can reach.
+    """
+    def __init__(self, unit, scan_delay, step=0.005):
+        self.step = step
+        self.unit = unit
+        self.scan_delay = scan_delay
+        # {(row, column): {worker}}
+        self.cells = defaultdict(set)
+        # {worker: ((row, column), last_request)}
+        self.idle = {}
+        # heap of [(last_request, worker_no, worker)], may hold stale entries
+        self.requests = []
+        # [min_row, max_row, min_column, max_column] of occupied cells
+        self.extent = None
+        # {(row, column): {Waiter}}
+        self.waiters = defaultdict(set)
+        self.numbers = count()
+        # highest speed limit any point has waited with
+        self.fastest = 0
+
+        # shortest distance a single step can cover within the bounds,
+        # with some leeway for workers that wander outside of them
+        lat = min(max(abs(bounds.north), abs(bounds.south)) + 1.0, 89.0)
+        self.gap = min(get_distance((0.0, 0.0), (step, 0.0), unit),
+                       get_distance((lat, 0.0), (lat, step), unit)) * 0.99
+
+    def __len__(self):
+        return len(self.idle)
+
+    def __contains__(self, worker):
+        return worker in self.idle
+
+    def cell(self, point):
+        return int(point[0] // self.step), int(point[1] // self.step)
+
+    def add(self, worker):
+        cell = self.cell(worker.location)
+        last_request = worker.last_request
+        self.cells[cell].add(worker)
+        self.idle[worker] = cell, last_request
+        heappush(self.requests, (last_request, worker.worker_no, worker))
+        if len(self.requests) > 4 * len(self.idle) + 64:
+            self.requests = [(x[1], w.worker_no, w) for w, x in self.idle.items()]
+            heapify(self.requests)
+
+        row, column = cell
+        extent = self.extent
+        if extent is None:
+            self.extent = [row, row, column, column]
+        else:
+            if row < extent[0]:
+                extent[0] = row
+            elif row > extent[1]:
+                extent[1] = row
+            if column < extent[2]:
+                extent[2] = column
+            elif column > extent[3]:
+                extent[3] = column
+
+        if self.waiters:
+            self.notify(worker, cell)
+
+    def remove(self, worker):
+        try:
+            cell, _ = self.idle.pop(worker)
+        except KeyError:
+            return
+        workers = self.cells[cell]
+        workers.discard(worker)
+        if not workers:
+            del self.cells[cell]
+
+    def oldest(self):
+        """Returns the earliest last_request of any idle worker"""
+        requests = self.requests
+        while requests:
+            last_request, _, worker = requests[0]
+            try:
+                if self.idle[worker][1] == last_request:
+                    return last_request
+            except KeyError:
+                pass
+            heappop(requests)
+        return None
+
+    @staticmethod
+    def ring(row, column, distance):
+        """Yields the cells that are a given number of steps from a cell"""
+        if distance == 0:
+            yield row, column
+            return
+        for c in range(column - distance, column + distance + 1):
+            yield row - distance, c
+            yield row + distance, c
+        for r in range(row - distance + 1, row + distance):
+            yield r, column - distance
+            yield r, column + distance
+
+    def best(self, point, good_enough=conf.GOOD_ENOUGH, limit=conf.SPEED_LIMIT):
+        """Returns the idle worker that can reach point the fastest
+
+        Rings of cells are searched outward until no worker in the next ring
+        could possibly beat the lowest speed found, even if it were the one
+        that has been idle the longest. Returns (None, limit) if no worker
+        is below the speed limit.
+        """
+        oldest = self.oldest()
+        if oldest is None:
+            return None, limit
+        # the most time any idle worker has had to travel, in hours
+        hours = max(time() - oldest, self.scan_delay) / 3600
+
+        row, column = self.cell(point)
+        min_row, max_row, min_column, max_column = self.extent
+        last_ring = max(row - min_row, max_row - row,
+                        column - min_column, max_column - column)
+
+        cells = self.cells
+        gap = self.gap
+        worker = None
+        lowest = limit
+        for distance in range(last_ring + 1):
+            if distance > 1 and (distance - 1) * gap / hours >= lowest:
+                break
+            for cell in self.ring(row, column, distance):
+                for w in cells.get(cell, ()):
+                    speed = w.travel_speed(point)
+                    if speed < lowest:
+                        lowest = speed
+                        worker = w
+                        if speed < good_enough:
+                            return worker, speed
+        return worker, lowest
+
+    def reachable(self, worker, point, limit):
+        """Returns the time at which an idle worker could reach point under limit"""
+        seconds = get_distance(worker.location, point, self.unit) * 3600 / limit
+        if seconds < self.scan_delay:
+            return worker.last_request
+        return worker.last_request + seconds + 0.01
+
+    def earliest(self, point, limit=conf.SPEED_LIMIT):
+        """Returns the soonest time at which any idle worker could reach point
+
+        Searched in rings like best(), stopping once even the longest idle
+        worker would need more time to cover the distance to the next ring.
+        """
+        oldest = self.oldest()
+        if oldest is None:
+            return None
+
+        row, column = self.cell(point)
+        min_row, max_row, min_column, max_column = self.extent
+        last_ring = max(row - min_row, max_row - row,
+                        column - min_column, max_column - column)
+
+        cells = self.cells
+        seconds_per_ring = self.gap * 3600 / limit
+        soonest = float('inf')
+        for distance in range(last_ring + 1):
+            if distance > 1 and oldest + (distance - 1) * seconds_per_ring >= soonest:
+                break
+            for cell in self.ring(row, column, distance):
+                for w in cells.get(cell, ()):
+                    when = self.reachable(w, point, limit)
+                    if when < soonest:
+                        soonest = when
+        return soonest
+
+    def wait(self, point, limit=conf.SPEED_LIMIT):
+        """Returns a future that is resolved when a worker may reach point"""
+        waiter = Waiter(point, limit, self.cell(point), next(self.numbers))
+        self.waiters[waiter.cell].add(waiter)
+        if limit > self.fastest:
+            self.fastest = limit
+        waiter.future.add_done_callback(lambda f: self.forget(waiter))
+        self.schedule(waiter, self.earliest(point, limit))
+        return waiter.future
+
+    def schedule(self, waiter, when):
+        if when is None or (waiter.when is not None and when >= waiter.when):
+            return
+        delay = when - time()
+        if delay <= 0:
+            self.wake(waiter)
+            return
+        if waiter.handle:
+            waiter.handle.cancel()
+        waiter.when = when
+        waiter.handle = LOOP.call_later(delay, self.wake, waiter)
+
+    @staticmethod
+    def wake(waiter):
+        if not waiter.future.done():
+            waiter.future.set_result(None)
+
+    def notify(self, worker, cell, horizon=max(conf.GIVE_UP_KNOWN, conf.GIVE_UP_UNKNOWN)):
+        """Wake the longest waiting point that a released worker can reach
+
+        Points that it will be able to reach within horizon seconds are
+        rescheduled if that's sooner than they expected.
+        """
+        now = time()
+        seconds = max(now - worker.last_request, self.scan_delay) + horizon
+        rings = int(self.fastest * seconds / 3600 // self.gap) + 1
+        row, column = cell
+        if (2 * rings + 1) ** 2 > len(self.waiters):
+            cells = [waiters for (r, c), waiters in self.waiters.items()
+                     if abs(r - row) <= rings and abs(c - column) <= rings]
+        else:
+            cells = [self.waiters[r, c]
+                     for r in range(row - rings, row + rings + 1)
+                     for c in range(column - rings, column + rings + 1)
+                     if (r, c) in self.waiters]
+        first = None
+        for waiters in cells:
+            for waiter in waiters:
+                if waiter.future.done():
+                    continue
+                when = self.reachable(worker, waiter.point, waiter.limit)
+                if when > now:
+                    self.schedule(waiter, when)
+                elif first is None or waiter.number < first.number:
+                    first = waiter
+        if first:
+            self.wake(first)
+
+    def forget(self, waiter):
+        waiters = self.waiters[waiter.cell]
+        waiters.discard(waiter)
+        if not waiters:
+            del self.waiters[waiter.cell]
+        if waiter.handle:
+            waiter.handle.cancel()
+
+    def wake_all(self):
+        for waiters in tuple(self.waiters.values()):
+            for waiter in tuple(waiters):
+                self.wake(waiter)
@@ -12,23 +12,26 @@ except ImportError:
 
 from multiprocessing.managers import BaseManager, DictProxy
 from queue import Queue, Full
+from itertools import chain
+from threading import Thread
 from argparse import ArgumentParser
 from signal import signal, SIGINT, SIGTERM, SIG_IGN
 from logging import getLogger, basicConfig, WARNING, INFO
 from logging.handlers import RotatingFileHandler
 from os.path import exists, join
 from sys import platform
-from time import monotonic, sleep
+from time import monotonic
 
 from sqlalchemy.exc import DBAPIError
 from aiopogo import close_sessions, activate_hash_server
 
-from monocle.shared import LOOP, get_logger, SessionManager, ACCOUNTS
+from monocle.shared import LOOP, get_logger, run_threaded, SessionManager, ACCOUNTS
 from monocle.utils import get_address, dump_pickle
 from monocle.worker import Worker
 from monocle.overseer import Overseer
 from monocle.db import FORT_CACHE
-from monocle import altitudes, db_proc, spawns
+from monocle.shards import get_regions, split_workers, start_shard
+from monocle import altitudes, db_proc, metrics, spawns
 
 
 class AccountManager(BaseManager):
@@ -61,6 +64,7 @@ class CustomQueue(Queue):
 _captcha_queue = CustomQueue()
 _extra_queue = Queue()
 _worker_dict = {}
+_db_queue = Queue()
 
 def get_captchas():
     return _captcha_queue
@@ -71,6 +75,9 @@ def get_extras():
 def get_workers():
     return _worker_dict
 
+def get_db_queue():
+    return _db_queue
+
 def mgr_init():
     signal(SIGINT, SIG_IGN)
 
@@ -100,6 +107,16 @@ def parse_args():
         help='Do not load spawns from pickle',
         action='store_false'
     )
+    parser.add_argument(
+        '--workers',
+        help='Run only this range of worker numbers, as START:STOP (used by shards)'
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=conf.METRICS_PORT,
+        help='Serve Prometheus metrics on this port'
+    )
     return parser.parse_args()
 
 
@@ -126,10 +143,13 @@ def exception_handler(loop, context):
         print('Exception in exception handler.')
 
 
-def cleanup(overseer, manager):
+def cleanup(overseer, manager, shard=False):
     try:
         overseer.print_handle.cancel()
         overseer.running = False
+        Worker.index.wake_all()
+        if overseer.jobs:
+            overseer.jobs.close()
         print('Exiting, please wait until all tasks finish')
 
         log = get_logger('cleanup')
@@ -145,29 +165,94 @@ def cleanup(overseer, manager):
             log = get_logger('cleanup')
             log.exception('A wild {} appeared during exit!', e.__class__.__name__)
 
+        if shard:
+            # the supervisor saves accounts and writes to the DB for shards
+            db_proc.add({'type': 'accounts', 'accounts': ACCOUNTS})
+            db_proc.stop()
+            db_proc.join()
+        else:
+            db_proc.stop()
+            overseer.refresh_dict()
+
+            print('Dumping pickles...')
+            dump_pickle('accounts', ACCOUNTS)
+            FORT_CACHE.pickle()
+            altitudes.save()
+            if conf.CACHE_CELLS:
+                Worker.cells.save()
+
+            spawns.pickle()
+            wait_for_db()
+    finally:
+        print('Closing pipes, sessions, and event loop...')
+        if not shard:
+            manager.shutdown()
+        SessionManager.close()
+        close_sessions()
+        LOOP.close()
+        print('Done.')
+
+
+def wait_for_db():
+    while not db_proc.queue.empty():
+        pending = db_proc.queue.qsize()
+        # Spaces at the end are important, as they clear previously printed
+        # output - \r doesn't clean whole line
+        print('{} DB items pending     '.format(pending), end='\r')
+        db_proc.join(.5)
+    db_proc.join()
+
+
+def supervise(manager, args):
+    """Run a scanner process for each region and write their DB items"""
+    log = get_logger('supervisor')
+    spawns.update()
+    regions = get_regions()
+    workers = split_workers(regions, chain(spawns.known, spawns.unknown))
+
+    Overseer.queue_accounts(manager.captcha_queue(), manager.extra_queue())
+    db_proc.start()
+    db_queue = manager.db_queue()
+    receiver = Thread(target=db_proc.receive, args=(db_queue, ACCOUNTS))
+    receiver.start()
+
+    if args.metrics_port:
+        LOOP.run_until_complete(metrics.serve(conf.METRICS_HOST, args.metrics_port))
+    shards = [start_shard(region, numbers, args.log_level, args.bootstrap,
+                          args.metrics_port and args.metrics_port + i + 1)
+              for i, (region, numbers) in enumerate(zip(regions, workers)) if numbers]
+    log.warning('Started {} shards.', len(shards))
+
+    def terminate(signum, frame):
+        for process in shards:
+            process.terminate()
+    signal(SIGTERM, terminate)
+
+    try:
+        # run the loop while waiting so that the DB processor keeps committing
+        LOOP.run_until_complete(gather(
+            *(run_threaded(process.wait) for process in shards), loop=LOOP))
+    except KeyboardInterrupt:
+        print('Exiting, please wait until all shards finish')
+        for process in shards:
+            if process.poll() is None:
+                process.send_signal(SIGINT)
+        for process in shards:
+            process.wait()
+    finally:
+        db_queue.put(None)
+        receiver.join()
+        extra_queue = manager.extra_queue()
+        while not extra_queue.empty():
+            account = extra_queue.get()
+            ACCOUNTS[account['username']] = account
         db_proc.stop()
-        overseer.refresh_dict()
 
         print('Dumping pickles...')
         dump_pickle('accounts', ACCOUNTS)
         FORT_CACHE.pickle()
-        altitudes.pickle()
-        if conf.CACHE_CELLS:
-            dump_pickle('cells', Worker.cells)
-
-        spawns.pickle()
-        while not db_proc.queue.empty():
-            pending = db_proc.queue.qsize()
-            # Spaces at the end are important, as they clear previously printed
-            # output - \r doesn't clean whole line
-            print('{} DB items pending     '.format(pending), end='\r')
-            sleep(.5)
-    finally:
-        print('Closing pipes, sessions, and event loop...')
+        wait_for_db()
         manager.shutdown()
-        SessionManager.close()
-        close_sessions()
-        LOOP.close()
         print('Done.')
 
 
@@ -181,27 +266,44 @@ def main():
     else:
         configure_logger(filename=None)
     log.setLevel(args.log_level)
+    shard = args.workers is not None
 
     AccountManager.register('captcha_queue', callable=get_captchas)
     AccountManager.register('extra_queue', callable=get_extras)
     if conf.MAP_WORKERS:
         AccountManager.register('worker_dict', callable=get_workers,
                                 proxytype=DictProxy)
+    AccountManager.register('db_queue', callable=get_db_queue)
     address = get_address()
     manager = AccountManager(address=address, authkey=conf.AUTHKEY)
-    try:
-        manager.start(mgr_init)
-    except (OSError, EOFError) as e:
-        if platform == 'win32' or not isinstance(address, str):
-            raise OSError('Another instance is running with the same manager address. Stop that process or change your MANAGER_ADDRESS.') from e
-        else:
-            raise OSError('Another instance is running with the same socket. Stop that process or: rm {}'.format(address)) from e
+    if shard:
+        manager.connect()
+    else:
+        try:
+            manager.start(mgr_init)
+        except (OSError, EOFError) as e:
+            if platform == 'win32' or not isinstance(address, str):
+                raise OSError('Another instance is running with the same manager address. Stop that process or change your MANAGER_ADDRESS.') from e
+            else:
+                raise OSError('Another instance is running with the same socket. Stop that process or: rm {}'.format(address)) from e
+
+        if conf.SHARDS > 1:
+            supervise(manager, args)
+            return
 
     LOOP.set_exception_handler(exception_handler)
 
     overseer = Overseer(manager)
-    overseer.start(args.status_bar)
-    launcher = LOOP.create_task(overseer.launch(args.bootstrap, args.pickle))
+    if shard:
+        start, stop = (int(x) for x in args.workers.split(':'))
+        db_proc.remote = manager.db_queue()
+        overseer.start(args.status_bar, range(start, stop))
+    else:
+        overseer.start(args.status_bar)
+    if args.metrics_port:
+        LOOP.run_until_complete(metrics.serve(conf.METRICS_HOST, args.metrics_port))
+    # shards load their region's spawns from the DB rather than the pickle
+    launcher = LOOP.create_task(overseer.launch(args.bootstrap, args.pickle and not shard))
     activate_hash_server(conf.HASH_KEY)
     if platform != 'win32':
         LOOP.add_signal_handler(SIGINT, launcher.cancel)
@@ -211,7 +313,7 @@ def main():
     except (KeyboardInterrupt, SystemExit):
         launcher.cancel()
     finally:
-        cleanup(overseer, manager)
+        cleanup(overseer, manager, shard)
 
 
 if __name__ == '__main__':
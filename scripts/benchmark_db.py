@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""Compare ways of writing sightings to the configured database
+
+Everything written is rolled back, so nothing is left in the database.
+With --readers, compares SQLite with and without SQLITE_WAL instead, writing
+to scratch databases in a temporary directory while other processes read
+the map.
+"""
+
+import sqlite3
+import sys
+
+from argparse import ArgumentParser
+from multiprocessing import Event, Process, Value
+from os.path import join
+from pathlib import Path
+from random import getrandbits, randint, uniform
+from tempfile import TemporaryDirectory
+from time import monotonic, time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+monocle_dir = Path(__file__).resolve().parents[1]
+sys.path.append(str(monocle_dir))
+
+from monocle import db, sanitized as conf
+
+
+def make_sightings(count):
+    now = int(time())
+    return [{
+        'type': 'pokemon',
+        'encounter_id': getrandbits(63),
+        'spawn_id': getrandbits(40) if conf.SPAWN_ID_INT else '{:011x}'.format(getrandbits(40)),
+        'pokemon_id': randint(1, 251),
+        'expire_timestamp': now + randint(60, 3600),
+        'lat': uniform(40.7, 40.8),
+        'lon': uniform(-111.9, -111.8),
+        'individual_attack': randint(0, 15),
+        'individual_defense': randint(0, 15),
+        'individual_stamina': randint(0, 15),
+        'move_1': randint(1, 250),
+        'move_2': randint(1, 250)
+    } for _ in range(count)]
+
+
+def orm(session, sightings):
+    for pokemon in sightings:
+        session.add(db.Sighting(**db.sighting_row(pokemon)))
+    session.flush()
+
+
+def core(session, sightings):
+    for pokemon in sightings:
+        db.execute_cached(session, db.INSERTS[db.Sighting.__table__], db.sighting_row(pokemon))
+
+
+def executemany(session, sightings):
+    db.execute_cached(session, db.INSERTS[db.Sighting.__table__],
+                      [db.sighting_row(pokemon) for pokemon in sightings])
+
+
+def multirow(session, sightings):
+    # SQLite allows 999 bound parameters per statement
+    per_statement = 999 // len(db.Sighting.__table__.columns)
+    rows = [db.sighting_row(pokemon) for pokemon in sightings]
+    for i in range(0, len(rows), per_statement):
+        session.execute(db.INSERTS[db.Sighting.__table__].values(rows[i:i + per_statement]))
+
+
+METHODS = {
+    'orm': orm,
+    'core': core,
+    'executemany': executemany,
+    'multirow': multirow
+}
+
+
+def benchmark(method, sightings, batch_size):
+    session = db.Session()
+    try:
+        start = monotonic()
+        for i in range(0, len(sightings), batch_size):
+            method(session, sightings[i:i + batch_size])
+        return len(sightings) / (monotonic() - start)
+    finally:
+        session.rollback()
+        session.close()
+
+
+def read_map(path, wal, stop, queries):
+    """Repeat the map's query for current sightings until stopped"""
+    connection = sqlite3.connect(path, timeout=30)
+    if wal:
+        db.tune_sqlite(connection)
+        connection.execute('PRAGMA query_only=ON')
+    while not stop.is_set():
+        connection.execute(
+            'SELECT pokemon_id, spawn_id, expire_timestamp, lat, lon '
+            'FROM sightings WHERE expire_timestamp > ?', (int(time()),)).fetchall()
+        with queries.get_lock():
+            queries.value += 1
+    connection.close()
+
+
+def benchmark_readers(wal, sightings, batch_size, readers, seconds):
+    """Write batches for the given seconds while readers query the map"""
+    with TemporaryDirectory() as directory:
+        path = join(directory, 'benchmark.sqlite')
+        if wal:
+            engine = create_engine('sqlite:///' + path, poolclass=StaticPool)
+            event.listen(engine, 'connect', db.tune_sqlite)
+        else:
+            engine = create_engine('sqlite:///' + path)
+        db.Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        stop = Event()
+        queries = Value('L', 0)
+        processes = [Process(target=read_map, args=(path, wal, stop, queries))
+                     for _ in range(readers)]
+        for process in processes:
+            process.start()
+        written = locked = 0
+        try:
+            start = monotonic()
+            while monotonic() - start < seconds:
+                index = written % len(sightings)
+                batch = sightings[index:index + batch_size]
+                try:
+                    executemany(session, batch)
+                    session.commit()
+                    written += len(batch)
+                except OperationalError:
+                    session.rollback()
+                    locked += 1
+                # make the next pass over the sightings unique again
+                for pokemon in batch:
+                    pokemon['encounter_id'] = getrandbits(63)
+            elapsed = monotonic() - start
+        finally:
+            stop.set()
+            for process in processes:
+                process.join()
+            session.close()
+            engine.dispose()
+        return written / elapsed, queries.value / elapsed, locked
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=20000,
+                        help='sightings to write with each method')
+    parser.add_argument('--batch', type=int, default=500,
+                        help='sightings written by each call')
+    parser.add_argument('--readers', type=int, default=0,
+                        help='processes reading the map while SQLite is written')
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='how long to write with each SQLite mode')
+    parser.add_argument('methods', nargs='*',
+                        help='methods to compare, out of {}'.format(', '.join(METHODS)))
+    args = parser.parse_args()
+    for name in args.methods:
+        if name not in METHODS:
+            parser.error('unknown method: {}'.format(name))
+
+    sightings = make_sightings(args.count)
+    if args.readers:
+        print('Writing sightings in batches of {} with {} readers for {} seconds'.format(
+              args.batch, args.readers, args.seconds))
+        for wal in (False, True):
+            rate, queries, locked = benchmark_readers(
+                wal, sightings, args.batch, args.readers, args.seconds)
+            print('{:>12}: {:>9,.0f} sightings/second, {:,.1f} map queries/second, {} locked batches'.format(
+                  'WAL' if wal else 'default', rate, queries, locked))
+        return
+
+    print('Writing {} sightings in batches of {} to {}'.format(
+          args.count, args.batch, db.DB_TYPE))
+    for name in args.methods or METHODS:
+        rate = benchmark(METHODS[name], sightings, args.batch)
+        print('{:>12}: {:>9,.0f} sightings/second'.format(name, rate))
+
+
+if __name__ == '__main__':
+    main()
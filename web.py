@@ -121,7 +121,7 @@ if conf.MAP_WORKERS:
 def report_main(area_name=conf.AREA_NAME,
                 names=POKEMON,
                 key=conf.GOOGLE_MAPS_KEY if conf.REPORT_MAPS else None):
-    with db.session_scope() as session:
+    with db.session_scope(read_only=True) as session:
         counts = db.get_sightings_per_pokemon(session)
 
         count = sum(counts.values())
@@ -183,7 +183,7 @@ def report_main(area_name=conf.AREA_NAME,
 def report_single(pokemon_id,
                   area_name=conf.AREA_NAME,
                   key=conf.GOOGLE_MAPS_KEY if conf.REPORT_MAPS else None):
-    with db.session_scope() as session:
+    with db.session_scope(read_only=True) as session:
         session_stats = db.get_session_stats(session)
         js_data = {
             'charts_data': {
@@ -211,7 +211,7 @@ def report_single(pokemon_id,
 @app.route('/report/heatmap')
 def report_heatmap():
     pokemon_id = request.args.get('id')
-    with db.session_scope() as session:
+    with db.session_scope(read_only=True) as session:
         return dumps(db.get_all_spawn_coords(session, pokemon_id=pokemon_id))
 
 